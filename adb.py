@@ -0,0 +1,184 @@
+"""
+Async façade over db.py.
+
+Every db function listed below is exposed here under the same name as a coroutine, so callers
+can migrate one call at a time:  `get_setting(k)` -> `await adb.get_setting(k)`.
+
+Queries run off the event loop: writes on a single writer thread (SQLite allows one writer
+anyway, so a BEGIN IMMEDIATE wait never blocks updates), reads on a small pool of reader
+threads. Each thread gets its own connection through db.cur; WAL lets readers run alongside
+the writer.
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import db
+from config import DB_READ_WORKERS
+
+logger = logging.getLogger("pingx.adb")
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+_readers = ThreadPoolExecutor(max_workers=max(1, DB_READ_WORKERS), thread_name_prefix="db-read")
+
+READ_FUNCS = (
+    "get_setting",
+    "get_admin_ids",
+    "is_admin",
+    "get_support_ids",
+    "is_support",
+    "is_staff",
+    "count_users",
+    "count_reachable_users",
+    "get_counter",
+    "list_referrals",
+    "get_referral",
+    "list_referral_joiners",
+    "db_get_wallet",
+    "db_list_pending_payments_page",
+    "db_get_payment",
+    "db_get_plan",
+    "db_list_plans",
+    "db_get_plans_for_user",
+    "user_has_test_purchase",
+    "get_active_purchase_for_inbound",
+    "list_active_purchases",
+    "user_purchases",
+    "user_active_purchases",
+    "cache_get_usage",
+    "list_tickets_page",
+    "list_ticket_messages_page",
+    "find_ticket_by_msg_id",
+    "get_global_discount_percent",
+    "purchases_stats_range",
+    "events_count",
+    "rollup_stats_range",
+    "rollup_daily_series",
+    "rollup_events_count",
+    "due_notices",
+    "active_purchase_ids",
+    "purchases_for_sync",
+    "broadcast_get",
+    "broadcast_list_running",
+    "user_ids_after",
+)
+
+WRITE_FUNCS = (
+    "set_setting",
+    "add_admin",
+    "remove_admin",
+    "add_support",
+    "remove_support",
+    "create_referral",
+    "update_referral_title",
+    "update_referral_description",
+    "inc_referral_click",
+    "inc_referral_signup",
+    "save_or_update_user",
+    "mark_unreachable",
+    "db_add_wallet",
+    "try_deduct_wallet",
+    "rollback_wallet",
+    "db_new_payment",
+    "db_update_payment_status",
+    "db_insert_plan",
+    "db_update_plan_field",
+    "db_delete_plan",
+    "db_swap_plan_order",
+    "db_new_purchase",
+    "mark_purchase_superseded",
+    "cache_set_usage",
+    "cache_set_usage_many",
+    "mark_notices_sent",
+    "broadcast_create",
+    "broadcast_set_admin_msg",
+    "broadcast_set_status",
+    "broadcast_advance",
+    "get_or_open_ticket",
+    "ticket_set_activity",
+    "ticket_close",
+    "store_tmsg",
+)
+
+
+async def run_read(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, functools.partial(fn, *args, **kwargs))
+
+
+async def run_write(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_writer, functools.partial(fn, *args, **kwargs))
+
+
+def _rows(sql: str, params) -> list[dict]:
+    return [dict(r) for r in db.cur.execute(sql, params).fetchall()]
+
+
+def _row(sql: str, params) -> dict | None:
+    r = db.cur.execute(sql, params).fetchone()
+    return dict(r) if r else None
+
+
+def _exec(sql: str, params) -> int:
+    c = db.cur.execute(sql, params)
+    return c.lastrowid if sql.lstrip()[:6].upper() == "INSERT" else c.rowcount
+
+
+async def fetchall(sql: str, params=()) -> list[dict]:
+    return await run_read(_rows, sql, params)
+
+
+async def fetchone(sql: str, params=()) -> dict | None:
+    return await run_read(_row, sql, params)
+
+
+async def execute(sql: str, params=()) -> int:
+    """Run a write statement; returns lastrowid for INSERT, rowcount otherwise."""
+    return await run_write(_exec, sql, params)
+
+
+def _wrap(fn, runner):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await runner(fn, *args, **kwargs)
+
+    return wrapper
+
+
+for _name in READ_FUNCS:
+    globals()[_name] = _wrap(getattr(db, _name), run_read)
+for _name in WRITE_FUNCS:
+    globals()[_name] = _wrap(getattr(db, _name), run_write)
+del _name
+
+
+async def run_event_sink(interval: float):
+    """Flush db.event_sink on the writer thread every `interval` seconds, or sooner when it fills up."""
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    db.event_sink.attach(lambda: loop.call_soon_threadsafe(wake.set))
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+            try:
+                await run_write(db.event_sink.flush)
+            except Exception:
+                logger.exception("event sink flush failed")
+    finally:
+        db.event_sink.detach()
+
+
+def shutdown():
+    db.event_sink.detach()
+    try:
+        # Whatever the flusher did not get to yet.
+        _writer.submit(db.event_sink.flush).result()
+    except Exception:
+        logger.exception("final event sink flush failed")
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,126 @@
+"""
+Broadcast jobs: one message to every user, persisted in `broadcast_jobs` so a restart picks
+up where it stopped.
+
+Reachable users (see db.mark_unreachable) are streamed in id order, BROADCAST_CHUNK at a
+time. Each chunk goes to the outbound dispatcher's bulk lane in one go (it paces sends at the
+global rate and honours RetryAfter), then the cursor and counters are saved in one UPDATE. Between chunks the runner re-reads the
+job status, which is how pause and cancel take effect. The cursor only moves after a whole
+chunk, so a crash can repeat at most one chunk.
+"""
+import asyncio
+import logging
+import time
+from aiogram.enums import ParseMode
+import adb
+from db import log_evt
+import outbound
+from keyboards import kb_broadcast_job
+
+logger = logging.getLogger("pingx.broadcast")
+
+BROADCAST_CHUNK = 200
+PROGRESS_EDIT_SEC = 3.0
+STATUS_LABELS = {"running": "در حال ارسال", "paused": "متوقف", "cancelled": "لغو شد", "done": "پایان یافت"}
+
+_runners: dict[int, asyncio.Task] = {}
+
+
+def audit_meta(job: dict) -> dict:
+    """audit_logs entry for a finished job; written by the runner when done, by the cancel button otherwise."""
+    return {"job": job["id"], "status": job["status"], "sent": job["sent"], "failed": job["failed"], "message": job["text"][:200]}
+
+
+def progress_text(job: dict) -> str:
+    return (
+        f"📢 پیام همگانی #{job['id']}\n"
+        f"وضعیت: {STATUS_LABELS.get(job['status'], job['status'])}\n"
+        f"ارسال‌شده: {job['sent']} | ناموفق: {job['failed']} | کاربران در دسترس: ~{job['total']}"
+    )
+
+
+async def show_progress(bot, job_id: int):
+    job = await adb.broadcast_get(job_id)
+    if not job or not job.get("admin_msg_id"):
+        return
+    try:
+        await bot.edit_message_text(
+            progress_text(job),
+            chat_id=job["admin_chat_id"],
+            message_id=job["admin_msg_id"],
+            reply_markup=kb_broadcast_job(job),
+        )
+    except Exception:
+        pass  # unchanged text or message gone
+
+
+async def start(bot, text: str, sender_id: int, admin_chat_id: int) -> int:
+    total = await adb.count_reachable_users()
+    job_id = await adb.broadcast_create(sender_id, text, total)
+    job = await adb.broadcast_get(job_id)
+    try:
+        msg = await bot.send_message(admin_chat_id, progress_text(job), reply_markup=kb_broadcast_job(job))
+        await adb.broadcast_set_admin_msg(job_id, admin_chat_id, msg.message_id)
+    except Exception:
+        logger.warning("broadcast #%s: progress message failed", job_id, exc_info=True)
+    resume(bot, job_id)
+    return job_id
+
+
+def resume(bot, job_id: int):
+    """Start the runner for a job unless one is already going (it will notice the status itself)."""
+    task = _runners.get(job_id)
+    if task is None or task.done():
+        _runners[job_id] = asyncio.create_task(_run(bot, job_id))
+
+
+async def resume_all(bot):
+    """Called on startup: continue every job that was running when the process stopped."""
+    for job in await adb.broadcast_list_running():
+        logger.info("broadcast #%s: resuming after user_id=%s", job["id"], job["cursor_user_id"])
+        resume(bot, job["id"])
+
+
+async def _send_one(bot, uid: int, text: str) -> bool:
+    try:
+        await outbound.send(bot.send_message, uid, text, parse_mode=ParseMode.HTML, priority=outbound.BULK)
+        return True
+    except Exception:
+        return False
+
+
+async def _run(bot, job_id: int):
+    cursor = None
+    last_edit = 0.0
+    try:
+        job = await adb.broadcast_get(job_id)
+        if not job or job["status"] != "running":
+            return
+        cursor = job["cursor_user_id"]
+        while True:
+            ids = await adb.user_ids_after(cursor, BROADCAST_CHUNK)
+            if not ids:
+                await adb.broadcast_set_status(job_id, "done", ("running",))
+                break
+            results = await asyncio.gather(*(_send_one(bot, uid, job["text"]) for uid in ids))
+            sent = sum(results)
+            cursor = ids[-1]
+            status = await adb.broadcast_advance(job_id, cursor, sent, len(ids) - sent)
+            if time.monotonic() - last_edit >= PROGRESS_EDIT_SEC:
+                last_edit = time.monotonic()
+                await show_progress(bot, job_id)
+            if status != "running":
+                break
+    except Exception:
+        # Leave it resumable from the progress message instead of "running" with no runner.
+        logger.exception("broadcast #%s failed at user_id=%s, pausing", job_id, cursor)
+        try:
+            await adb.broadcast_set_status(job_id, "paused", ("running",))
+        except Exception:
+            logger.exception("broadcast #%s: could not mark paused", job_id)
+    finally:
+        _runners.pop(job_id, None)
+    await show_progress(bot, job_id)
+    job = await adb.broadcast_get(job_id)
+    if job and job["status"] == "done":
+        log_evt(job["created_by"], "broadcast", audit_meta(job))
@@ -9,14 +9,32 @@ if not BOT_TOKEN:
 
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS","").replace(" ","").split(",") if x}
 DB_PATH = os.getenv("DB_PATH","bot.db")
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS","4") or 4)
+EVENT_BUFFER_MAX = int(os.getenv("EVENT_BUFFER_MAX","10000") or 10000)
+EVENT_FLUSH_SEC = float(os.getenv("EVENT_FLUSH_SEC","2") or 2)
 
 REQUIRED_CHANNEL = os.getenv("REQUIRED_CHANNEL","@piingx").strip() or "@piingx"
 REQUIRED_CHANNELS = os.getenv("REQUIRED_CHANNELS","").strip() or REQUIRED_CHANNEL
+FORCE_JOIN_MEMBER_TTL_SEC = int(os.getenv("FORCE_JOIN_MEMBER_TTL_SEC","600") or 600)
+FORCE_JOIN_NONMEMBER_TTL_SEC = int(os.getenv("FORCE_JOIN_NONMEMBER_TTL_SEC","30") or 30)
+CHANNEL_DETAILS_TTL_SEC = int(os.getenv("CHANNEL_DETAILS_TTL_SEC","3600") or 3600)
 
 THREEXUI_BASE_URL = os.getenv("THREEXUI_BASE_URL","").rstrip("/")
 THREEXUI_USERNAME  = os.getenv("THREEXUI_USERNAME","")
 THREEXUI_PASSWORD  = os.getenv("THREEXUI_PASSWORD","")
 THREEXUI_INBOUND_ID = int(os.getenv("THREEXUI_INBOUND_ID","39") or "39")
+THREEXUI_KEEPALIVE_SEC = int(os.getenv("THREEXUI_KEEPALIVE_SEC","300") or 0)
+
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS","8") or 8)
+SYNC_DEADLINE_SEC = int(os.getenv("SYNC_DEADLINE_SEC","600") or 600)
+SYNC_TICK_SEC = int(os.getenv("SYNC_TICK_SEC","60") or 60)
+SYNC_INTERVAL_SEC = int(os.getenv("SYNC_INTERVAL_SEC","1800") or 1800)
+SYNC_MIN_INTERVAL_SEC = int(os.getenv("SYNC_MIN_INTERVAL_SEC","300") or 300)
+SYNC_MAX_INTERVAL_SEC = int(os.getenv("SYNC_MAX_INTERVAL_SEC","10800") or 10800)
+SYNC_SHARDS = int(os.getenv("SYNC_SHARDS","30") or 30)
+SYNC_JITTER = float(os.getenv("SYNC_JITTER","0.1") or 0)
+USAGE_ALERT_THRESHOLDS = os.getenv("USAGE_ALERT_THRESHOLDS","50,80,95,100")
+EXPIRY_ALERT_DAYS = os.getenv("EXPIRY_ALERT_DAYS","7,3,1,0")
 
 SUB_HOST   = os.getenv("SUB_HOST","").strip()
 SUB_SCHEME = os.getenv("SUB_SCHEME","https")
@@ -31,5 +49,9 @@ PAGE_SIZE_USERS    = int(os.getenv("PAGE_SIZE_USERS","10"))
 PAGE_SIZE_PAYMENTS = int(os.getenv("PAGE_SIZE_PAYMENTS","10"))
 PAGE_SIZE_TICKETS  = int(os.getenv("PAGE_SIZE_TICKETS","10"))
 
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE","30") or 30)
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE","1") or 1)
+TG_GROUP_PER_MIN = float(os.getenv("TG_GROUP_PER_MIN","20") or 20)
+
 TICKET_GROUP_ID = int(os.getenv("TICKET_GROUP_ID","0") or 0)
 SUPPORT_GROUP_ID = int(os.getenv("SUPPORT_GROUP_ID","0") or 0)
@@ -1,4 +1,7 @@
-import sqlite3, json
+import sqlite3, json, threading, time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from config import (
     DB_PATH,
@@ -10,18 +13,74 @@ from config import (
     SUB_SCHEME,
     SUB_PATH,
     SUB_PORT,
+    USAGE_ALERT_THRESHOLDS,
+    EXPIRY_ALERT_DAYS,
     MAX_RECEIPT_PHOTOS,
     MAX_RECEIPT_MB,
+    EVENT_BUFFER_MAX,
 )
-from utils import now_iso
+from utils import now_iso, now_iso_ms, iso_to_ms
 
 TZ = timezone.utc
-conn = sqlite3.connect(DB_PATH, isolation_level=None, timeout=5, check_same_thread=False)
-conn.execute("PRAGMA busy_timeout=5000;")
-conn.row_factory = sqlite3.Row
-cur = conn.cursor()
-cur.execute("PRAGMA journal_mode=WAL;")
-cur.execute("PRAGMA synchronous=NORMAL;")
+
+
+def _connect() -> sqlite3.Connection:
+    c = sqlite3.connect(DB_PATH, isolation_level=None, timeout=5, check_same_thread=False)
+    c.execute("PRAGMA busy_timeout=5000;")
+    c.execute("PRAGMA synchronous=NORMAL;")
+    c.row_factory = sqlite3.Row
+    return c
+
+
+conn = _connect()
+conn.execute("PRAGMA journal_mode=WAL;")
+_local = threading.local()
+_local.cur = conn.cursor()
+
+
+class _ThreadCursor:
+    """
+    Module-level `cur` that resolves to a cursor on the calling thread's own connection.
+    The main thread keeps using `conn`; worker threads (see adb.py) lazily open their own,
+    so a transaction on one thread never interleaves with statements from another.
+    """
+
+    def _cursor(self) -> sqlite3.Cursor:
+        c = getattr(_local, "cur", None)
+        if c is None:
+            c = _local.cur = _connect().cursor()
+        return c
+
+    def __getattr__(self, name):
+        return getattr(self._cursor(), name)
+
+
+cur = _ThreadCursor()
+
+
+@contextmanager
+def transaction():
+    """BEGIN IMMEDIATE ... COMMIT on this thread's connection; joins a transaction that is already open."""
+    if cur.connection.in_transaction:
+        yield
+        return
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+
+def _execute_ddl(script: str):
+    """Like executescript(), but without its implicit COMMIT, so it is safe inside a migration."""
+    stmt = ""
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            cur.execute(stmt)
+            stmt = ""
 
 
 def col_exists(table, col) -> bool:
@@ -33,7 +92,7 @@ def add_col(table, col, ddl):
         cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl};")
 
 
-def migrate():
+def _migration_1_baseline():
     cur.execute(
         """
     CREATE TABLE IF NOT EXISTS users(
@@ -187,14 +246,438 @@ def migrate():
     );"""
     )
 
+    # Indexes for the hot query shapes (active-purchase lookups, pending payments, reports, admin lists).
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_purchases_user_inbound_active ON purchases(user_id, three_xui_inbound_id, id) WHERE active=1;"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_purchases_active_expiry ON purchases(expiry_ms) WHERE active=1;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tmsg_tg_msg ON ticket_messages(tg_msg_id);")
+    _migrate_epoch_ms()
+
+    _migrate_users_fts()
+    _migrate_daily_rollups()
+
+    # Row counters kept by triggers so list headers never need COUNT(1) over a whole table.
+    cur.execute("CREATE TABLE IF NOT EXISTS counters(name TEXT PRIMARY KEY, n INTEGER NOT NULL DEFAULT 0);")
+    cur.execute("INSERT OR IGNORE INTO counters(name,n) SELECT 'users', COUNT(1) FROM users;")
+    cur.execute("INSERT OR IGNORE INTO counters(name,n) SELECT 'tickets', COUNT(1) FROM tickets;")
+    cur.execute("INSERT OR IGNORE INTO counters(name,n) SELECT 'payments_pending', COUNT(1) FROM payments WHERE status='pending';")
+    _execute_ddl(
+        """
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_users_ins AFTER INSERT ON users BEGIN
+        UPDATE counters SET n=n+1 WHERE name='users';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_users_del AFTER DELETE ON users BEGIN
+        UPDATE counters SET n=n-1 WHERE name='users';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_tickets_ins AFTER INSERT ON tickets BEGIN
+        UPDATE counters SET n=n+1 WHERE name='tickets';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_tickets_del AFTER DELETE ON tickets BEGIN
+        UPDATE counters SET n=n-1 WHERE name='tickets';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_pay_ins AFTER INSERT ON payments WHEN NEW.status='pending' BEGIN
+        UPDATE counters SET n=n+1 WHERE name='payments_pending';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_pay_upd AFTER UPDATE OF status ON payments
+    WHEN (OLD.status='pending') <> (NEW.status='pending') BEGIN
+        UPDATE counters SET n=n+(NEW.status='pending')-(OLD.status='pending') WHERE name='payments_pending';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_pay_del AFTER DELETE ON payments WHEN OLD.status='pending' BEGIN
+        UPDATE counters SET n=n-1 WHERE name='payments_pending';
+    END;
+    """
+    )
+
+
+def _migration_2_trial_used_at():
+    # Denormalised "has had a test plan" marker so trial checks are a primary-key lookup.
+    add_col("users", "trial_used_at", "TEXT")
+    # Same rule as the old per-row scan: the plan is flagged test or the purchase meta says so.
+    # Python truthiness of the JSON value ~ NOT IN (0, '') (false extracts as 0, null as NULL).
+    cur.execute(
+        """
+        UPDATE users SET trial_used_at = (
+            SELECT COALESCE(MIN(p.created_at), '') FROM purchases p
+            LEFT JOIN plans pl ON pl.id = p.plan_id
+            WHERE p.user_id = users.user_id AND (
+                (json_valid(pl.flags) AND json_extract(pl.flags, '$.test') NOT IN (0, ''))
+                OR (json_valid(p.meta) AND json_extract(p.meta, '$.test') NOT IN (0, ''))
+                OR lower(p.meta) = 'test'
+            )
+            HAVING COUNT(1) > 0
+        )
+        WHERE trial_used_at IS NULL
+        """
+    )
+
+
+def _migration_3_usage_ratio_index():
+    # Serves the usage half of due_notices(); the expression must match _USAGE_RATIO_SQL exactly.
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_cache_usage_ratio ON cache_usage((CAST(up + down AS REAL) / total)) WHERE total > 0;"
+    )
+
+
+def _migration_4_broadcast_jobs():
+    cur.execute(
+        """
+    CREATE TABLE IF NOT EXISTS broadcast_jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_by INTEGER,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor_user_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        admin_chat_id INTEGER,
+        admin_msg_id INTEGER,
+        created_at TEXT,
+        updated_at TEXT,
+        finished_at TEXT
+    );"""
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status);")
+
+
+def _migration_5_unreachable_users():
+    # Set when Telegram reports the chat as blocked/deleted, cleared on the next /start.
+    # Broadcasts walk the reachable index; notices exclude the (small) unreachable one.
+    add_col("users", "unreachable_at", "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE unreachable_at IS NULL;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users(user_id) WHERE unreachable_at IS NOT NULL;")
+
+
+def _migration_6_settings_version():
+    # Bumped on every write to settings from any connection; the settings cache compares it
+    # instead of PRAGMA data_version, which moves on every commit by any other connection.
+    cur.execute("INSERT OR IGNORE INTO counters(name,n) VALUES('settings', 0);")
+    _execute_ddl(
+        """
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_settings_ins AFTER INSERT ON settings BEGIN
+        UPDATE counters SET n=n+1 WHERE name='settings';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_settings_upd AFTER UPDATE ON settings BEGIN
+        UPDATE counters SET n=n+1 WHERE name='settings';
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_cnt_settings_del AFTER DELETE ON settings BEGIN
+        UPDATE counters SET n=n+1 WHERE name='settings';
+    END;
+    """
+    )
+
+
+def _migration_7_keyset_keys_not_null():
+    # Keyset pages compare (created_at_ms, user_id) / (last_activity_ms, id) row values, and a
+    # NULL key drops the row out of every page. Rows written without the ms twin (older code,
+    # manual inserts, a restore) get it here; unparseable text becomes 0, i.e. oldest.
+    users_ms = _ISO_TO_MS_SQL.format(col="NEW.created_at")
+    tickets_ms = _ISO_TO_MS_SQL.format(col="NEW.last_activity")
+    _execute_ddl(
+        f"""
+    CREATE TRIGGER IF NOT EXISTS trg_users_created_ms AFTER INSERT ON users
+    WHEN NEW.created_at_ms IS NULL BEGIN
+        UPDATE users SET created_at_ms=COALESCE({users_ms}, 0) WHERE user_id=NEW.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tickets_activity_ms_ins AFTER INSERT ON tickets
+    WHEN NEW.last_activity_ms IS NULL BEGIN
+        UPDATE tickets SET last_activity_ms=COALESCE({tickets_ms}, 0) WHERE id=NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tickets_activity_ms_upd AFTER UPDATE ON tickets
+    WHEN NEW.last_activity_ms IS NULL BEGIN
+        UPDATE tickets SET last_activity_ms=COALESCE({tickets_ms}, 0) WHERE id=NEW.id;
+    END;
+    """
+    )
+
+
+# Schema steps, applied in order; PRAGMA user_version records the last one applied.
+# Never edit a released step: append a new one. Step 1 is idempotent so it also adopts
+# databases created before versioning existed (user_version 0).
+MIGRATIONS = [
+    (1, _migration_1_baseline),
+    (2, _migration_2_trial_used_at),
+    (3, _migration_3_usage_ratio_index),
+    (4, _migration_4_broadcast_jobs),
+    (5, _migration_5_unreachable_users),
+    (6, _migration_6_settings_version),
+    (7, _migration_7_keyset_keys_not_null),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version() -> int:
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    """
+    Apply pending schema steps in one transaction, then the chunked *_ms backfill if it has not
+    completed yet; an up-to-date database costs a single PRAGMA and a cached settings lookup.
+    """
+    global USERS_FTS_ENABLED
+    current = schema_version()
+    pending = [(v, step) for v, step in MIGRATIONS if v > current]
+    if pending:
+        with transaction():
+            for _v, step in pending:
+                step()
+            cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    if get_setting("EPOCH_MS_BACKFILLED") != EPOCH_MS_BACKFILL_REV:
+        # After the schema commit, so the per-chunk transactions really are short. Idempotent
+        # (only NULL rows are touched), so an interrupted run simply continues on the next start.
+        for table, col in EPOCH_MS_COLUMNS:
+            _backfill_epoch_ms(table, col)
+        set_setting("EPOCH_MS_BACKFILLED", EPOCH_MS_BACKFILL_REV)
+    USERS_FTS_ENABLED = bool(
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users_fts'").fetchone()
+    )
+
+
+# In-process copy of the settings table. set_setting writes through; writes from any other
+# connection (another process, a restore, a worker thread) are noticed via the trigger-kept
+# 'settings' counter, checked at most every SETTINGS_PROBE_SEC.
+SETTINGS_PROBE_SEC = 2.0
+_settings: dict | None = None
+_settings_lock = threading.RLock()
+_settings_gen = 0
+_settings_version = None
+_settings_checked_at = 0.0
+
+
+def _stored_settings_version():
+    try:
+        r = cur.execute("SELECT n FROM counters WHERE name='settings'").fetchone()
+    except sqlite3.OperationalError:
+        return None  # fresh database, mid-migration
+    return r[0] if r else None
+
+
+def reload_settings():
+    """(Re)load the whole settings table into the cache."""
+    global _settings, _settings_gen, _settings_version, _settings_checked_at
+    with _settings_lock:
+        _settings_version = _stored_settings_version()
+        _settings_checked_at = time.monotonic()
+        fresh = {r[0]: r[1] for r in cur.execute("SELECT key,value FROM settings").fetchall()}
+        if fresh != _settings:
+            _settings = fresh
+            _settings_gen += 1
+        return _settings
+
+
+def _settings_map() -> dict:
+    global _settings_checked_at
+    if _settings is None:
+        return reload_settings()
+    if time.monotonic() - _settings_checked_at >= SETTINGS_PROBE_SEC:
+        with _settings_lock:
+            _settings_checked_at = time.monotonic()
+            changed = _stored_settings_version() != _settings_version
+        if changed:
+            return reload_settings()
+    return _settings
+
+
+def settings_generation() -> int:
+    """Bumped whenever the cached settings change; lets derived caches know when to rebuild."""
+    _settings_map()
+    return _settings_gen
+
+
+# Integer epoch-ms twins of the ISO text timestamps; range scans and sorting use these.
+EPOCH_MS_COLUMNS = (
+    ("users", "created_at"),
+    ("payments", "created_at"),
+    ("purchases", "created_at"),
+    ("events", "created_at"),
+    ("ticket_messages", "created_at"),
+    ("referral_links", "created_at"),
+    ("referral_joins", "joined_at"),
+    ("tickets", "last_activity"),
+    ("cache_usage", "updated_at"),
+)
+_ISO_TO_MS_SQL = "CAST(ROUND((julianday({col}) - 2440587.5) * 86400000) AS INTEGER)"
+# Bump to re-run the backfill on databases that already completed an older one.
+# "2": text that does not parse is filled with 0 instead of being left NULL.
+EPOCH_MS_BACKFILL_REV = "2"
+
+
+def _backfill_epoch_ms(table: str, col: str, chunk: int = 5000):
+    """
+    Fill {col}_ms from the text column a chunk at a time, each chunk its own short transaction.
+    Unparseable or missing text becomes 0 so no row is left with a NULL sort key.
+    """
+    expr = _ISO_TO_MS_SQL.format(col=col)
+    while True:
+        with transaction():
+            changed = cur.execute(
+                f"""
+                UPDATE {table} SET {col}_ms=COALESCE({expr}, 0)
+                WHERE rowid IN (SELECT rowid FROM {table} WHERE {col}_ms IS NULL LIMIT ?)
+                """,
+                (chunk,),
+            ).rowcount
+        if changed <= 0:
+            break
+
+
+def _migrate_epoch_ms():
+    for table, col in EPOCH_MS_COLUMNS:
+        add_col(table, f"{col}_ms", "INTEGER")
+    # Replace the text-keyed indexes with their integer equivalents.
+    for old in ("idx_purchases_created", "idx_events_event_created", "idx_users_created", "idx_tickets_order"):
+        cur.execute(f"DROP INDEX IF EXISTS {old};")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_purchases_created_ms ON purchases(created_at_ms);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_event_created_ms ON events(event, created_at_ms);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_created_ms ON users(created_at_ms);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_order_ms ON tickets((status='open'), last_activity_ms, id);")
+
+
+def _migrate_daily_rollups():
+    """Per-day aggregates kept by insert triggers so reports read a handful of rows per day."""
+    cur.execute(
+        """
+    CREATE TABLE IF NOT EXISTS daily_stats(
+        day TEXT PRIMARY KEY,
+        signups INTEGER NOT NULL DEFAULT 0,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0
+    );"""
+    )
+    cur.execute(
+        """
+    CREATE TABLE IF NOT EXISTS daily_events(
+        day TEXT NOT NULL, event TEXT NOT NULL, n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(event, day)
+    );"""
+    )
+    cur.execute(
+        """
+    CREATE TABLE IF NOT EXISTS daily_buyers(
+        day TEXT NOT NULL, user_id INTEGER NOT NULL,
+        PRIMARY KEY(day, user_id)
+    ) WITHOUT ROWID;"""
+    )
+    _execute_ddl(
+        """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_users AFTER INSERT ON users WHEN NEW.created_at IS NOT NULL BEGIN
+        INSERT INTO daily_stats(day, signups) VALUES(substr(NEW.created_at,1,10), 1)
+        ON CONFLICT(day) DO UPDATE SET signups=signups+1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_purchases AFTER INSERT ON purchases WHEN NEW.created_at IS NOT NULL BEGIN
+        INSERT INTO daily_stats(day, orders, revenue) VALUES(substr(NEW.created_at,1,10), 1, COALESCE(NEW.price,0))
+        ON CONFLICT(day) DO UPDATE SET orders=orders+1, revenue=revenue+COALESCE(NEW.price,0);
+        INSERT OR IGNORE INTO daily_buyers(day, user_id) VALUES(substr(NEW.created_at,1,10), NEW.user_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_events AFTER INSERT ON events WHEN NEW.created_at IS NOT NULL BEGIN
+        INSERT INTO daily_events(day, event, n) VALUES(substr(NEW.created_at,1,10), NEW.event, 1)
+        ON CONFLICT(event, day) DO UPDATE SET n=n+1;
+    END;
+    """
+    )
+    if not get_setting("DAILY_ROLLUPS_BUILT"):
+        rebuild_daily_rollups()
+        set_setting("DAILY_ROLLUPS_BUILT", now_iso())
+
+
+def rebuild_daily_rollups(since_day: str | None = None):
+    """
+    Catch-up job: recompute rollups from the base tables, for every day or from `since_day` on.
+    Used on first migration and after restoring an old backup.
+    """
+    since = since_day or ""
+    with transaction():
+        cur.execute("DELETE FROM daily_stats WHERE day>=?", (since,))
+        cur.execute("DELETE FROM daily_events WHERE day>=?", (since,))
+        cur.execute("DELETE FROM daily_buyers WHERE day>=?", (since,))
+        cur.execute(
+            """
+            INSERT INTO daily_stats(day, signups)
+            SELECT substr(created_at,1,10), COUNT(1) FROM users
+            WHERE created_at IS NOT NULL AND created_at>=? GROUP BY 1
+            """,
+            (since,),
+        )
+        cur.execute(
+            """
+            INSERT INTO daily_stats(day, orders, revenue)
+            SELECT substr(created_at,1,10), COUNT(1), COALESCE(SUM(price),0) FROM purchases
+            WHERE created_at IS NOT NULL AND created_at>=? GROUP BY 1
+            ON CONFLICT(day) DO UPDATE SET orders=excluded.orders, revenue=excluded.revenue
+            """,
+            (since,),
+        )
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO daily_buyers(day, user_id)
+            SELECT DISTINCT substr(created_at,1,10), user_id FROM purchases
+            WHERE created_at IS NOT NULL AND created_at>=?
+            """,
+            (since,),
+        )
+        cur.execute(
+            """
+            INSERT INTO daily_events(day, event, n)
+            SELECT substr(created_at,1,10), event, COUNT(1) FROM events
+            WHERE created_at IS NOT NULL AND created_at>=? GROUP BY 1, 2
+            """,
+            (since,),
+        )
+
+
+# Trigram full-text index over users for admin search; stays off if this SQLite build lacks FTS5/trigram.
+USERS_FTS_ENABLED = False
+
+
+def _migrate_users_fts():
+    global USERS_FTS_ENABLED
+    try:
+        cur.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username, first_name, last_name, uid, tokenize='trigram');"
+        )
+    except sqlite3.OperationalError:
+        USERS_FTS_ENABLED = False
+        return
+    USERS_FTS_ENABLED = True
+    # Backfill users saved before the index existed (or by an older build).
+    cur.execute(
+        """
+        INSERT INTO users_fts(rowid, username, first_name, last_name, uid)
+        SELECT user_id, COALESCE(username,''), COALESCE(first_name,''), COALESCE(last_name,''), CAST(user_id AS TEXT)
+        FROM users WHERE user_id NOT IN (SELECT rowid FROM users_fts)
+        """
+    )
+
+
+def users_fts_match(q: str) -> str | None:
+    """MATCH expression for a substring search, or None when the FTS index can't serve it (<3 chars)."""
+    q = (q or "").strip()
+    if not USERS_FTS_ENABLED or len(q) < 3:
+        return None
+    return '"' + q.replace('"', '""') + '"'
+
 
 def set_setting(k, v):
-    cur.execute("INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)", (k, v))
+    global _settings_gen, _settings_version
+    with transaction():
+        cur.execute("INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)", (k, v))
+        version = _stored_settings_version()
+    if v is not None and not isinstance(v, str):
+        v = str(v)  # TEXT affinity: mirror what SQLite stores
+    with _settings_lock:
+        if _settings is not None and _settings.get(k) != v:
+            _settings[k] = v
+            _settings_gen += 1
+        # Our own write is already applied; only skip the reload if nobody else wrote in between.
+        if version is not None and _settings_version is not None and version == _settings_version + 1:
+            _settings_version = version
 
 
 def get_setting(k, default=None):
-    r = cur.execute("SELECT value FROM settings WHERE key=?", (k,)).fetchone()
-    return (r and r[0]) or default
+    return _settings_map().get(k) or default
 
 
 def _parse_ids_csv(csv_str: str | None) -> set[int]:
@@ -210,18 +693,37 @@ def _parse_ids_csv(csv_str: str | None) -> set[int]:
     return res
 
 
-def get_admin_ids() -> set[int]:
-    extra = _parse_ids_csv(get_setting("ADMIN_IDS", ""))
-    base = set(int(x) for x in (CONF_ADMIN_IDS or set()))
-    return base.union(extra)
+# Role sets derived from ADMIN_IDS (env + settings) and SUPPORT_IDS. Rebuilt only when the
+# settings generation moves (add_/remove_admin and add_/remove_support go through set_setting).
+_roles_gen = -1
+_admin_ids: frozenset = frozenset()
+_support_ids: frozenset = frozenset()
 
 
-def is_admin(uid: int) -> bool:
+def _roles() -> tuple[frozenset, frozenset]:
+    global _roles_gen, _admin_ids, _support_ids
+    gen = settings_generation()
+    if gen != _roles_gen:
+        base = {int(x) for x in (CONF_ADMIN_IDS or set())}
+        _admin_ids = frozenset(base | _parse_ids_csv(get_setting("ADMIN_IDS", "")))
+        _support_ids = frozenset(_parse_ids_csv(get_setting("SUPPORT_IDS", "")))
+        _roles_gen = gen
+    return _admin_ids, _support_ids
+
+
+def _as_uid(uid) -> int | None:
     try:
-        uid = int(uid)
+        return int(uid)
     except Exception:
-        return False
-    return uid in get_admin_ids()
+        return None
+
+
+def get_admin_ids() -> set[int]:
+    return set(_roles()[0])
+
+
+def is_admin(uid: int) -> bool:
+    return _as_uid(uid) in _roles()[0]
 
 
 def add_admin(uid: int):
@@ -240,19 +742,17 @@ def remove_admin(uid: int):
 
 
 def get_support_ids() -> set[int]:
-    return _parse_ids_csv(get_setting("SUPPORT_IDS", ""))
+    return set(_roles()[1])
 
 
 def is_support(uid: int) -> bool:
-    try:
-        uid = int(uid)
-    except Exception:
-        return False
-    return uid in get_support_ids()
+    return _as_uid(uid) in _roles()[1]
 
 
 def is_staff(uid: int) -> bool:
-    return is_admin(uid) or is_support(uid)
+    admins, support = _roles()
+    uid = _as_uid(uid)
+    return uid in admins or uid in support
 
 
 def add_support(uid: int):
@@ -271,7 +771,8 @@ def remove_support(uid: int):
 def ensure_defaults():
     # Only backfill defaults when a value is missing; don't override panel changes.
     def set_if_missing(key: str, value):
-        if get_setting(key) is None:
+        # Key presence, not truthiness: an empty value was set on purpose and must not be rewritten each boot.
+        if key not in _settings_map():
             set_setting(key, value)
 
     set_if_missing("ACTIVE_INBOUND_ID", str(THREEXUI_INBOUND_ID))
@@ -304,6 +805,8 @@ def ensure_defaults():
 
 
     set_if_missing("GLOBAL_DISCOUNT_PERCENT", "0")
+    set_if_missing("USAGE_ALERT_THRESHOLDS", USAGE_ALERT_THRESHOLDS)
+    set_if_missing("EXPIRY_ALERT_DAYS", EXPIRY_ALERT_DAYS)
     set_if_missing("SUPPORT_IDS", "")
 
 
@@ -312,6 +815,7 @@ def ensure_default_plans():
     legacy_ids = ("p1", "unlim30")
     if not get_setting(migration_flag):
         cur.executemany("DELETE FROM plans WHERE id=?", [(pid,) for pid in legacy_ids])
+        invalidate_plan_catalog()
         set_setting(migration_flag, "1")
     defs = [
         ("vol_lite", "پینگ لایت ⚡️ | ۲۵ گیگ | ۲ دستگاه | شروع اقتصادی", 30, 25, 49_000, {"device_limit": 2}),
@@ -325,45 +829,139 @@ def ensure_default_plans():
         ("trial1", "تست ۱ روزه | رایگان", 1, 0, 0, {"test": True}),
         ("admtrial7", "تست ۷ روزه (ادمین)", 7, 0, 0, {"admin_only": True, "test": True}),
     ]
+    # One read of the current rows; only plans that are missing or differ get written.
+    current = {
+        r["id"]: (r["title"], r["days"], r["gb"], r["price"], r["flags"])
+        for r in cur.execute("SELECT id, title, days, gb, price, flags FROM plans").fetchall()
+    }
+    upserts = []
     for pid, title, days, gb, price, flags in defs:
-        row = cur.execute("SELECT id FROM plans WHERE id=?", (pid,)).fetchone()
-        if row:
-            cur.execute(
-                "UPDATE plans SET title=?, days=?, gb=?, price=?, flags=? WHERE id=?",
-                (title, days, gb, price, json.dumps(flags, ensure_ascii=False), pid),
-            )
-        else:
-            cur.execute(
-                "INSERT INTO plans(id,title,days,gb,price,flags) VALUES(?,?,?,?,?,?)",
-                (pid, title, days, gb, price, json.dumps(flags, ensure_ascii=False)),
+        values = (title, days, gb, price, json.dumps(flags, ensure_ascii=False))
+        if current.get(pid) != values:
+            upserts.append((pid, *values))
+    if upserts:
+        with transaction():
+            cur.executemany(
+                """
+                INSERT INTO plans(id,title,days,gb,price,flags) VALUES(?,?,?,?,?,?)
+                ON CONFLICT(id) DO UPDATE SET title=excluded.title, days=excluded.days, gb=excluded.gb,
+                    price=excluded.price, flags=excluded.flags
+                """,
+                upserts,
             )
+        invalidate_plan_catalog()
+
+
+class EventSink:
+    """
+    Write-behind buffer for events and audit_logs rows.
+    Rows are queued in memory (bounded; overflow is dropped and counted) and written in one
+    transaction by flush(), which adb.run_event_sink() calls on a timer or when the queue reaches
+    flush_size. Until a flusher is attached, put() writes straight through.
+    """
+
+    def __init__(self, max_size: int, flush_size: int = 200):
+        self.max_size = max(1, max_size)
+        self.flush_size = flush_size
+        self._rows: deque = deque()
+        self._lock = threading.Lock()
+        self._wake = None
+        self.dropped = 0
+        self.flushed = 0
+
+    def attach(self, wake):
+        self._wake = wake
+
+    def detach(self):
+        self._wake = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def put(self, sql: str, params: tuple):
+        if self._wake is None:
+            cur.execute(sql, params)
+            return
+        with self._lock:
+            if len(self._rows) >= self.max_size:
+                self.dropped += 1
+                return
+            self._rows.append((sql, params))
+            full = len(self._rows) >= self.flush_size
+        if full and self._wake:
+            self._wake()
+
+    def flush(self) -> int:
+        with self._lock:
+            rows = list(self._rows)
+            self._rows.clear()
+        if not rows:
+            return 0
+        by_sql: dict[str, list] = {}
+        for sql, params in rows:
+            by_sql.setdefault(sql, []).append(params)
+        try:
+            with transaction():
+                for sql, batch in by_sql.items():
+                    cur.executemany(sql, batch)
+        except Exception:
+            self.dropped += len(rows)
+            raise
+        self.flushed += len(rows)
+        return len(rows)
+
+
+event_sink = EventSink(EVENT_BUFFER_MAX)
 
 
 def log_evt(actor_id: int, action: str, meta: dict):
-    cur.execute("INSERT INTO audit_logs(ts,actor_id,action,meta) VALUES(?,?,?,?)", (now_iso(), actor_id, action, json.dumps(meta, ensure_ascii=False)))
+    event_sink.put(
+        "INSERT INTO audit_logs(ts,actor_id,action,meta) VALUES(?,?,?,?)",
+        (now_iso(), actor_id, action, json.dumps(meta, ensure_ascii=False)),
+    )
 
 
 def log_event(user_id: int, event: str, meta: dict | None = None):
-    cur.execute(
-        "INSERT INTO events(user_id,event,meta_json,created_at) VALUES(?,?,?,?)",
-        (user_id, event, json.dumps(meta or {}, ensure_ascii=False), now_iso()),
+    ts, ms = now_iso_ms()
+    event_sink.put(
+        "INSERT INTO events(user_id,event,meta_json,created_at,created_at_ms) VALUES(?,?,?,?,?)",
+        (user_id, event, json.dumps(meta or {}, ensure_ascii=False), ts, ms),
     )
 
 
+def get_counter(name: str) -> int:
+    r = cur.execute("SELECT n FROM counters WHERE name=?", (name,)).fetchone()
+    return int(r[0]) if r else 0
+
+
 def count_users() -> int:
-    return cur.execute("SELECT COUNT(1) FROM users").fetchone()[0]
+    return get_counter("users")
+
+
+def keyset_result(rows: list, limit: int, after_id=None, before_id=None):
+    """
+    Finish a keyset page fetched with LIMIT limit+1 (in reverse order when paging `before`).
+    Returns (rows, has_prev, has_next).
+    """
+    more = len(rows) > limit
+    rows = [dict(r) for r in rows[:limit]]
+    if before_id is not None:
+        rows.reverse()
+        return rows, more, True
+    return rows, after_id is not None, more
 
 
 # Referral helpers
 def create_referral(code: str, title: str, created_by: int, description: str = ""):
+    ts, ms = now_iso_ms()
     cur.execute(
-        "INSERT INTO referral_links(code,title,description,created_by,created_at,clicks,signups) VALUES(?,?,?,?,?,0,0)",
-        (code, title, description, int(created_by), now_iso()),
+        "INSERT INTO referral_links(code,title,description,created_by,created_at,created_at_ms,clicks,signups) VALUES(?,?,?,?,?,?,0,0)",
+        (code, title, description, int(created_by), ts, ms),
     )
 
 
 def list_referrals():
-    return [dict(r) for r in cur.execute("SELECT * FROM referral_links ORDER BY created_at DESC").fetchall()]
+    return [dict(r) for r in cur.execute("SELECT * FROM referral_links ORDER BY created_at_ms DESC").fetchall()]
 
 
 def get_referral(code: str):
@@ -386,12 +984,13 @@ def inc_referral_click(code: str):
 def _record_referral_join(code: str, u):
     if not u:
         return
+    ts, ms = now_iso_ms()
     cur.execute(
         """
-    INSERT INTO referral_joins(code,user_id,username,first_name,last_name,joined_at)
-    VALUES(?,?,?,?,?,?)
+    INSERT INTO referral_joins(code,user_id,username,first_name,last_name,joined_at,joined_at_ms)
+    VALUES(?,?,?,?,?,?,?)
     """,
-        (code, u.id, u.username or "", u.first_name or "", u.last_name or "", now_iso()),
+        (code, u.id, u.username or "", u.first_name or "", u.last_name or "", ts, ms),
     )
 
 
@@ -409,14 +1008,33 @@ def inc_referral_signup(code: str, user=None):
 
 
 def save_or_update_user(u):
-    cur.execute(
+    ts, ms = now_iso_ms()
+    c = cur.execute(
         """
-    INSERT INTO users(user_id,username,first_name,last_name,wallet,created_at)
-    VALUES(?,?,?,?,0,?)
-    ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name
+    INSERT INTO users(user_id,username,first_name,last_name,wallet,created_at,created_at_ms)
+    VALUES(?,?,?,?,0,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name,
+        unreachable_at=NULL
+    WHERE username IS NOT excluded.username OR first_name IS NOT excluded.first_name OR last_name IS NOT excluded.last_name
+        OR unreachable_at IS NOT NULL
     """,
-        (u.id, u.username or "", u.first_name or "", u.last_name or "", now_iso()),
+        (u.id, u.username or "", u.first_name or "", u.last_name or "", ts, ms),
     )
+    if c.rowcount and USERS_FTS_ENABLED:
+        # New user, changed name or returning unreachable user: refresh the search index row.
+        cur.execute(
+            "INSERT OR REPLACE INTO users_fts(rowid, username, first_name, last_name, uid) VALUES(?,?,?,?,?)",
+            (u.id, u.username or "", u.first_name or "", u.last_name or "", str(u.id)),
+        )
+
+
+def mark_unreachable(uid: int):
+    """Telegram refused delivery (blocked bot, deleted account); cleared by save_or_update_user."""
+    cur.execute("UPDATE users SET unreachable_at=? WHERE user_id=? AND unreachable_at IS NULL", (now_iso(), uid))
+
+
+def count_reachable_users() -> int:
+    return cur.execute("SELECT COUNT(1) FROM users WHERE unreachable_at IS NULL").fetchone()[0]
 
 
 def db_get_wallet(uid: int) -> int:
@@ -447,17 +1065,23 @@ def rollback_wallet(uid: int, price: int):
 
 
 def db_new_payment(uid: int, amount: int, note: str, media: list[dict] | list[str]):
+    ts, ms = now_iso_ms()
     cur.execute(
-        "INSERT INTO payments(user_id,amount,note,photos_json,status,created_at) VALUES(?,?,?,?, 'pending', ?)",
-        (uid, amount, note, json.dumps(media, ensure_ascii=False), now_iso()),
+        "INSERT INTO payments(user_id,amount,note,photos_json,status,created_at,created_at_ms) VALUES(?,?,?,?, 'pending', ?, ?)",
+        (uid, amount, note, json.dumps(media, ensure_ascii=False), ts, ms),
     )
     return cur.lastrowid
 
 
-def db_list_pending_payments_page(offset: int, limit: int):
-    rows = cur.execute("SELECT * FROM payments WHERE status='pending' ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
-    total = cur.execute("SELECT COUNT(1) FROM payments WHERE status='pending'").fetchone()[0]
-    return [dict(x) for x in rows], total
+def db_list_pending_payments_page(limit: int, after_id: int | None = None, before_id: int | None = None):
+    """Newest first; `after_id`/`before_id` is the last/first payment id of the page being left."""
+    if before_id is not None:
+        q, params = "SELECT * FROM payments WHERE status='pending' AND id>? ORDER BY id ASC LIMIT ?", (before_id, limit + 1)
+    elif after_id is not None:
+        q, params = "SELECT * FROM payments WHERE status='pending' AND id<? ORDER BY id DESC LIMIT ?", (after_id, limit + 1)
+    else:
+        q, params = "SELECT * FROM payments WHERE status='pending' ORDER BY id DESC LIMIT ?", (limit + 1,)
+    return keyset_result(cur.execute(q, params).fetchall(), limit, after_id, before_id)
 
 
 def db_get_payment(pid: int):
@@ -469,13 +1093,82 @@ def db_update_payment_status(pid: int, status: str):
     cur.execute("UPDATE payments SET status=? WHERE id=?", (status, pid))
 
 
+@dataclass(frozen=True)
+class PlanFlags:
+    """Typed view of plans.flags (a JSON object). Keys this code doesn't know are kept in `extra`."""
+
+    admin_only: bool = False
+    test: bool = False
+    device_limit: int = 0
+    extra: dict = field(default_factory=dict, compare=False)
+
+    @classmethod
+    def parse(cls, raw) -> "PlanFlags":
+        try:
+            d = json.loads(raw or "{}")
+        except (TypeError, ValueError):
+            d = {}
+        if not isinstance(d, dict):
+            d = {}
+        try:
+            device_limit = int(d.get("device_limit") or 0)
+        except (TypeError, ValueError):
+            device_limit = 0
+        extra = {k: v for k, v in d.items() if k not in ("admin_only", "test", "device_limit")}
+        return cls(bool(d.get("admin_only")), bool(d.get("test")), device_limit, extra)
+
+
+class PlanCatalog:
+    """
+    The plans table, loaded once with flags parsed (`plan["plan_flags"]`).
+    Every plan write goes through invalidate_plan_catalog(), which bumps `version` so
+    anything derived from a catalog (e.g. the buy-menu keyboards) knows to rebuild.
+    Plan dicts are shared between callers: treat them as read-only.
+    """
+
+    def __init__(self, plans: list[dict], version: int):
+        self.version = version
+        self.plans = tuple(plans)
+        self.by_id = {p["id"]: p for p in self.plans}
+
+
+_plan_catalog: PlanCatalog | None = None
+_plan_catalog_version = 0
+_plan_catalog_lock = threading.Lock()
+
+
+def plan_catalog() -> PlanCatalog:
+    global _plan_catalog
+    cat = _plan_catalog
+    if cat is None:
+        with _plan_catalog_lock:
+            cat = _plan_catalog
+            if cat is None:
+                plans = [dict(r) for r in cur.execute("SELECT * FROM plans ORDER BY sort_order ASC, id ASC").fetchall()]
+                for p in plans:
+                    p["plan_flags"] = PlanFlags.parse(p.get("flags"))
+                cat = _plan_catalog = PlanCatalog(plans, _plan_catalog_version)
+    return cat
+
+
+def invalidate_plan_catalog():
+    global _plan_catalog, _plan_catalog_version
+    with _plan_catalog_lock:
+        _plan_catalog_version += 1
+        _plan_catalog = None
+
+
+def plan_flags(plan: dict) -> PlanFlags:
+    return plan.get("plan_flags") or PlanFlags.parse(plan.get("flags"))
+
+
 def db_get_plan(pid: str):
-    r = cur.execute("SELECT * FROM plans WHERE id=?", (pid,)).fetchone()
-    return dict(r) if r else None
+    p = plan_catalog().by_id.get(pid)
+    return dict(p) if p else None
 
 
 def db_list_plans():
-    return [dict(r) for r in cur.execute("SELECT * FROM plans ORDER BY sort_order ASC, id ASC").fetchall()]
+    return [dict(p) for p in plan_catalog().plans]
 
 
 def db_insert_plan(pid: str, title: str, days: int, gb: int, price: int, flags: dict | None = None):
@@ -483,16 +1176,19 @@ def db_insert_plan(pid: str, title: str, days: int, gb: int, price: int, flags:
         "INSERT INTO plans(id,title,days,gb,price,flags) VALUES(?,?,?,?,?,?)",
         (pid, title, int(days), int(gb), int(price), json.dumps(flags or {}, ensure_ascii=False)),
     )
+    invalidate_plan_catalog()
 
 
 def db_update_plan_field(pid: str, field: str, value):
     if field not in ("title", "days", "gb", "price", "flags"):
         raise ValueError("invalid field")
     cur.execute(f"UPDATE plans SET {field}=? WHERE id=?", (value, pid))
+    invalidate_plan_catalog()
 
 
 def db_delete_plan(pid: str):
     cur.execute("DELETE FROM plans WHERE id=?", (pid,))
+    invalidate_plan_catalog()
 
 
 def db_swap_plan_order(pid: str, direction: str):
@@ -515,53 +1211,43 @@ def db_swap_plan_order(pid: str, direction: str):
     order_b = int(b.get("sort_order") or target_idx)
     cur.execute("UPDATE plans SET sort_order=? WHERE id=?", (order_b, a["id"]))
     cur.execute("UPDATE plans SET sort_order=? WHERE id=?", (order_a, b["id"]))
+    invalidate_plan_catalog()
     return True
 
 
 def db_get_plans_for_user(is_admin: bool):
-    rows = [dict(r) for r in cur.execute("SELECT * FROM plans ORDER BY sort_order ASC, id ASC").fetchall()]
-    res = []
-    for p in rows:
-        import json
+    return [p for p in plan_catalog().plans if is_admin or not p["plan_flags"].admin_only]
 
-        flags = json.loads(p.get("flags") or "{}")
-        if flags.get("admin_only") and not is_admin:
-            continue
-        res.append(p)
-    return res
+
+# uid -> whether the user ever received a test plan. Only db_new_purchase can turn it True,
+# and it updates the entry itself; a restore clears the map (forget_trial_status).
+_trial_used: dict[int, bool] = {}
+TRIAL_CACHE_MAX = 100_000
+
+
+def forget_trial_status():
+    _trial_used.clear()
+
+
+def _meta_is_test(meta) -> bool:
+    if not meta:
+        return False
+    try:
+        m = json.loads(meta)
+        return isinstance(m, dict) and bool(m.get("test"))
+    except Exception:
+        return str(meta).lower() == "test"
 
 
 def user_has_test_purchase(uid: int) -> bool:
-    """
-    Detect if user has ever received a test plan.
-    Uses LEFT JOIN so even deleted plans are considered, and also inspects purchase.meta.
-    """
-    rows = cur.execute(
-        """
-        SELECT p.plan_id, p.meta, COALESCE(pl.flags, '{}') AS flags
-        FROM purchases p
-        LEFT JOIN plans pl ON pl.id = p.plan_id
-        WHERE p.user_id=?
-        """,
-        (uid,),
-    ).fetchall()
-    for r in rows:
-        try:
-            flags = json.loads(r["flags"] or "{}")
-        except Exception:
-            flags = {}
-        if flags.get("test"):
-            return True
-        meta = r["meta"]
-        if meta:
-            try:
-                m = json.loads(meta)
-                if isinstance(m, dict) and m.get("test"):
-                    return True
-            except Exception:
-                if str(meta).lower() == "test":
-                    return True
-    return False
+    hit = _trial_used.get(uid)
+    if hit is None:
+        r = cur.execute("SELECT trial_used_at FROM users WHERE user_id=?", (uid,)).fetchone()
+        hit = bool(r and r["trial_used_at"] is not None)
+        if len(_trial_used) >= TRIAL_CACHE_MAX:
+            _trial_used.clear()
+        _trial_used[uid] = hit
+    return hit
 
 
 def db_new_purchase(**kw):
@@ -577,12 +1263,14 @@ def db_new_purchase(**kw):
         "allocated_gb",
         "expiry_ms",
         "created_at",
+        "created_at_ms",
         "meta",
         "active",
         "superseded_by",
     ]
+    ts, ms = now_iso_ms()
     cur.execute(
-        f"INSERT INTO purchases ({','.join(fields)}) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        f"INSERT INTO purchases ({','.join(fields)}) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
         (
             kw.get("user_id"),
             kw.get("plan_id"),
@@ -594,13 +1282,21 @@ def db_new_purchase(**kw):
             kw.get("sub_link"),
             kw.get("allocated_gb"),
             kw.get("expiry_ms"),
-            now_iso(),
+            ts,
+            ms,
             kw.get("meta"),
             int(kw.get("active")) if kw.get("active") is not None else 1,
             kw.get("superseded_by"),
         ),
     )
-    return cur.lastrowid
+    purchase_id = cur.lastrowid
+    plan = plan_catalog().by_id.get(kw.get("plan_id"))
+    if (plan and plan["plan_flags"].test) or _meta_is_test(kw.get("meta")):
+        cur.execute(
+            "UPDATE users SET trial_used_at=? WHERE user_id=? AND trial_used_at IS NULL", (ts, kw.get("user_id"))
+        )
+        _trial_used[kw.get("user_id")] = True
+    return purchase_id
 
 
 def mark_purchase_superseded(old_id: int, new_id: int):
@@ -638,6 +1334,34 @@ def list_active_purchases(now_ms: int | None = None, inbound_id: int | str | Non
     return [dict(r) for r in cur.execute(q, params).fetchall()]
 
 
+def active_purchase_ids(now_ms: int, after_id: int = 0) -> list[int]:
+    """Ids of active, unexpired purchases above `after_id` (the sync queue only asks for new ones)."""
+    return [
+        r[0]
+        for r in cur.execute(
+            "SELECT id FROM purchases WHERE id>? AND active=1 AND (expiry_ms IS NULL OR expiry_ms=0 OR expiry_ms>?) ORDER BY id",
+            (after_id, now_ms),
+        ).fetchall()
+    ]
+
+
+def purchases_for_sync(ids: list[int], now_ms: int) -> list[dict]:
+    """
+    The given purchases that are still active and unexpired, each with the usage cached by the
+    previous sync (`prev_used`, `prev_total`, `prev_ms`) for estimating its consumption rate.
+    """
+    rows = cur.execute(
+        """
+        SELECT p.*, c.up + c.down AS prev_used, c.total AS prev_total, c.updated_at_ms AS prev_ms
+        FROM purchases p LEFT JOIN cache_usage c ON c.purchase_id = p.id
+        WHERE p.id IN (SELECT value FROM json_each(?))
+          AND p.active=1 AND (p.expiry_ms IS NULL OR p.expiry_ms=0 OR p.expiry_ms>?)
+        """,
+        (json.dumps(list(ids)), now_ms),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
 def user_purchases(uid: int):
     return [dict(r) for r in cur.execute("SELECT * FROM purchases WHERE user_id=? ORDER BY id DESC", (uid,)).fetchall()]
 
@@ -652,11 +1376,132 @@ def user_active_purchases(uid: int):
     ]
 
 
+# Upsert that leaves unchanged rows untouched; the usage alert level survives unless usage was
+# reset or the quota changed (renewal / upgrade), after which thresholds are announced afresh.
+_CACHE_USAGE_UPSERT = """
+    INSERT INTO cache_usage(purchase_id,up,down,total,expiry_ms,updated_at,updated_at_ms) VALUES(?,?,?,?,?,?,?)
+    ON CONFLICT(purchase_id) DO UPDATE SET
+        last_usage_warn=CASE WHEN excluded.up+excluded.down < up+down OR excluded.total IS NOT total
+            THEN NULL ELSE last_usage_warn END,
+        up=excluded.up, down=excluded.down, total=excluded.total, expiry_ms=excluded.expiry_ms,
+        updated_at=excluded.updated_at, updated_at_ms=excluded.updated_at_ms
+    WHERE up IS NOT excluded.up OR down IS NOT excluded.down OR total IS NOT excluded.total OR expiry_ms IS NOT excluded.expiry_ms
+"""
+
+
 def cache_set_usage(purchase_id: int, up: int, down: int, total: int, expiry_ms: int):
-    cur.execute(
-        "INSERT OR REPLACE INTO cache_usage(purchase_id,up,down,total,expiry_ms,updated_at) VALUES(?,?,?,?,?,?)",
-        (purchase_id, up, down, total, expiry_ms, now_iso()),
-    )
+    cur.execute(_CACHE_USAGE_UPSERT, (purchase_id, up, down, total, expiry_ms, *now_iso_ms()))
+
+
+def cache_set_usage_many(rows: list[tuple], batch_size: int = 500) -> int:
+    """
+    Write (purchase_id, up, down, total, expiry_ms) tuples, one transaction per batch.
+    Rows identical to what is cached are skipped. Returns the number of rows written.
+    """
+    ts, ms = now_iso_ms()
+    written = 0
+    for i in range(0, len(rows), batch_size):
+        batch = [(*r, ts, ms) for r in rows[i : i + batch_size]]
+        with transaction():
+            written += max(0, cur.executemany(_CACHE_USAGE_UPSERT, batch).rowcount)
+    return written
+
+
+DAY_MS = 86_400_000
+_USAGE_RATIO_SQL = "CAST(c.up + c.down AS REAL) / c.total"
+_alert_gen = -1
+_alert_levels: tuple[tuple[int, ...], tuple[int, ...]] = ((), ())
+
+
+def _int_csv(value, lo: int, hi: int) -> tuple[int, ...]:
+    out = set()
+    for part in str(value or "").replace(" ", "").split(","):
+        try:
+            n = int(part)
+        except ValueError:
+            continue
+        if lo <= n <= hi:
+            out.add(n)
+    return tuple(sorted(out))
+
+
+def alert_levels() -> tuple[tuple[int, ...], tuple[int, ...]]:
+    """(usage percents, expiry days) from USAGE_ALERT_THRESHOLDS / EXPIRY_ALERT_DAYS, both ascending."""
+    global _alert_gen, _alert_levels
+    gen = settings_generation()
+    if gen != _alert_gen:
+        _alert_levels = (
+            _int_csv(get_setting("USAGE_ALERT_THRESHOLDS", USAGE_ALERT_THRESHOLDS), 1, 100),
+            _int_csv(get_setting("EXPIRY_ALERT_DAYS", EXPIRY_ALERT_DAYS), 0, 365),
+        )
+        _alert_gen = gen
+    return _alert_levels
+
+
+_UNREACHABLE_SQL = "SELECT user_id FROM users WHERE unreachable_at IS NOT NULL"
+
+
+def due_notices(now_ms: int) -> list[dict]:
+    """
+    Active purchases that crossed a usage or expiry threshold since their last notice,
+    as (kind, purchase_id, user_id, level) rows; level is the threshold reached (percent / days).
+
+    Levels are computed in SQL from the configured thresholds. The last level notified is kept
+    per purchase (cache_usage.last_usage_warn, purchases.last_expiry_notice), so jumping
+    over several thresholds in one sync yields a single notice for the highest one. Each half
+    walks an index over its candidate band only. Users marked unreachable are left out; their
+    notices stay due until they /start again.
+    """
+    usage_pcts, expiry_days = alert_levels()
+    parts, params = [], []
+    if usage_pcts:
+        level = " ".join(f"WHEN {_USAGE_RATIO_SQL} >= {t / 100!r} THEN {t}" for t in reversed(usage_pcts))
+        parts.append(
+            f"""
+            SELECT 'usage' AS kind, id AS purchase_id, user_id, level FROM (
+                SELECT p.id, p.user_id, CASE {level} END AS level, c.last_usage_warn
+                FROM cache_usage c JOIN purchases p ON p.id = c.purchase_id
+                WHERE c.total > 0 AND {_USAGE_RATIO_SQL} >= ? AND p.active = 1
+                  AND p.user_id NOT IN ({_UNREACHABLE_SQL})
+            )
+            WHERE level > CAST(COALESCE(last_usage_warn, '0') AS INTEGER)
+            """
+        )
+        params.append(usage_pcts[0] / 100)
+    if expiry_days:
+        days_left = f"(p.expiry_ms - {int(now_ms)} + {DAY_MS - 1}) / {DAY_MS}"
+        level = " ".join(f"WHEN {days_left} <= {d} THEN {d}" for d in expiry_days)
+        # Level 0 means "expired": announced once, only within a day of expiring.
+        parts.append(
+            f"""
+            SELECT 'expiry', id, user_id, level FROM (
+                SELECT p.id, p.user_id, CASE {level} END AS level, p.last_expiry_notice
+                FROM purchases p
+                WHERE p.active = 1 AND p.expiry_ms > ? AND p.expiry_ms <= ?
+                  AND p.user_id NOT IN ({_UNREACHABLE_SQL})
+            )
+            WHERE level IS NOT last_expiry_notice
+            """
+        )
+        params += [now_ms - (DAY_MS if expiry_days[0] == 0 else 0), now_ms + expiry_days[-1] * DAY_MS]
+    if not parts:
+        return []
+    return [dict(r) for r in cur.execute(" UNION ALL ".join(parts), params).fetchall()]
+
+
+def mark_notices_sent(usage: list[tuple[int, int]], expiry: list[tuple[int, int]]):
+    """Record sent notices in one transaction; both lists hold (purchase_id, level)."""
+    if not usage and not expiry:
+        return
+    ts = now_iso()
+    with transaction():
+        cur.executemany(
+            "UPDATE cache_usage SET last_usage_warn=? WHERE purchase_id=?", [(str(lvl), pid) for pid, lvl in usage]
+        )
+        cur.executemany(
+            "UPDATE purchases SET last_expiry_notice=?, last_expiry_notice_at=? WHERE id=?",
+            [(lvl, ts, pid) for pid, lvl in expiry],
+        )
 
 
 def cache_get_usage(purchase_id: int):
@@ -668,16 +1513,22 @@ def get_or_open_ticket(uid: int) -> int:
     row = cur.execute("SELECT id FROM tickets WHERE user_id=? AND status='open' ORDER BY id DESC LIMIT 1", (uid,)).fetchone()
     if row:
         return row["id"]
-    cur.execute("INSERT INTO tickets(user_id,status,opened_at,closed_at,last_activity) VALUES (?,?,?,?,?)", (uid, "open", now_iso(), None, now_iso()))
+    ts, ms = now_iso_ms()
+    cur.execute(
+        "INSERT INTO tickets(user_id,status,opened_at,closed_at,last_activity,last_activity_ms) VALUES (?,?,?,?,?,?)",
+        (uid, "open", ts, None, ts, ms),
+    )
     return cur.lastrowid
 
 
 def ticket_set_activity(tid: int):
-    cur.execute("UPDATE tickets SET last_activity=? WHERE id=?", (now_iso(), tid))
+    ts, ms = now_iso_ms()
+    cur.execute("UPDATE tickets SET last_activity=?, last_activity_ms=? WHERE id=?", (ts, ms, tid))
 
 
 def ticket_close(tid: int):
-    cur.execute("UPDATE tickets SET status='closed', closed_at=?, last_activity=? WHERE id=?", (now_iso(), now_iso(), tid))
+    ts, ms = now_iso_ms()
+    cur.execute("UPDATE tickets SET status='closed', closed_at=?, last_activity=?, last_activity_ms=? WHERE id=?", (ts, ts, ms, tid))
 
 
 def store_tmsg(
@@ -694,10 +1545,10 @@ def store_tmsg(
     try:
         cur.execute(
             """
-        INSERT INTO ticket_messages(ticket_id,sender_type,sender_id,kind,content,caption,tg_msg_id,created_at,src_chat_id,src_message_id)
-        VALUES(?,?,?,?,?,?,?,?,?,?)
+        INSERT INTO ticket_messages(ticket_id,sender_type,sender_id,kind,content,caption,tg_msg_id,created_at,created_at_ms,src_chat_id,src_message_id)
+        VALUES(?,?,?,?,?,?,?,?,?,?,?)
         """,
-            (tid, sender_type, sender_id, kind, content, caption, tg_msg_id, now_iso(), src_chat_id, src_message_id),
+            (tid, sender_type, sender_id, kind, content, caption, tg_msg_id, *now_iso_ms(), src_chat_id, src_message_id),
         )
         return cur.lastrowid
     except sqlite3.IntegrityError:
@@ -705,31 +1556,44 @@ def store_tmsg(
         return None
 
 
-def list_tickets_page(page: int, size: int):
-    off = page * size
-    rows = [
-        dict(r)
-        for r in cur.execute(
-            """
+def list_tickets_page(size: int, after_id: int | None = None, before_id: int | None = None):
+    """
+    Open tickets first, then closed, each by last activity (newest first).
+    Walks the (is_open, last_activity_ms, id) index one segment at a time so deep pages stay cheap.
+    """
+    cursor_id = before_id if before_id is not None else after_id
+    key = None
+    if cursor_id is not None:
+        key = cur.execute("SELECT (status='open') AS o, last_activity_ms, id FROM tickets WHERE id=?", (cursor_id,)).fetchone()
+        if not key:
+            after_id = before_id = None
+    backward = key is not None and before_id is not None
+    segments = [0, 1] if backward else [1, 0]
+    if key is not None:
+        segments = segments[segments.index(int(key["o"])) :]
+    rows = []
+    for seg in segments:
+        q = """
         SELECT t.*, u.username, u.first_name, u.last_name
         FROM tickets t
         LEFT JOIN users u ON u.user_id = t.user_id
-        ORDER BY (t.status='open') DESC, t.last_activity DESC
-        LIMIT ? OFFSET ?
-    """,
-            (size, off),
-        ).fetchall()
-    ]
-    total = cur.execute("SELECT COUNT(1) FROM tickets").fetchone()[0]
-    return rows, total
-
-
-def list_ticket_messages_page(tid: int, page: int, size: int):
-    off = page * size
-    rows = [
-        dict(r)
-        for r in cur.execute(
-            """
+        WHERE (t.status='open')=?"""
+        params: list = [seg]
+        if key is not None and int(key["o"]) == seg:
+            q += f" AND (t.last_activity_ms, t.id) {'>' if backward else '<'} (?, ?)"
+            params += [key["last_activity_ms"], key["id"]]
+        q += " ORDER BY t.last_activity_ms ASC, t.id ASC" if backward else " ORDER BY t.last_activity_ms DESC, t.id DESC"
+        q += " LIMIT ?"
+        params.append(size + 1 - len(rows))
+        rows += cur.execute(q, params).fetchall()
+        if len(rows) > size:
+            break
+    return keyset_result(rows, size, after_id, before_id)
+
+
+def list_ticket_messages_page(tid: int, size: int, after_id: int | None = None, before_id: int | None = None):
+    """Oldest first; `after_id`/`before_id` is the last/first message id of the page being left."""
+    q = """
             SELECT
                 id,
                 ticket_id,
@@ -742,15 +1606,75 @@ def list_ticket_messages_page(tid: int, page: int, size: int):
                 kind,
                 sender_id
             FROM ticket_messages
-            WHERE ticket_id=?
-            ORDER BY id ASC
-            LIMIT ? OFFSET ?
-            """,
-            (tid, size, off),
-        ).fetchall()
+            WHERE ticket_id=?"""
+    if before_id is not None:
+        q += " AND id<? ORDER BY id DESC LIMIT ?"
+        params = (tid, before_id, size + 1)
+    elif after_id is not None:
+        q += " AND id>? ORDER BY id ASC LIMIT ?"
+        params = (tid, after_id, size + 1)
+    else:
+        q += " ORDER BY id ASC LIMIT ?"
+        params = (tid, size + 1)
+    return keyset_result(cur.execute(q, params).fetchall(), size, after_id, before_id)
+
+
+def broadcast_create(created_by: int, text: str, total: int) -> int:
+    ts = now_iso()
+    cur.execute(
+        "INSERT INTO broadcast_jobs(created_by,text,status,total,created_at,updated_at) VALUES(?,?,?,?,?,?)",
+        (created_by, text, "running", total, ts, ts),
+    )
+    return cur.lastrowid
+
+
+def broadcast_get(job_id: int):
+    r = cur.execute("SELECT * FROM broadcast_jobs WHERE id=?", (job_id,)).fetchone()
+    return dict(r) if r else None
+
+
+def broadcast_list_running() -> list[dict]:
+    return [dict(r) for r in cur.execute("SELECT * FROM broadcast_jobs WHERE status='running' ORDER BY id").fetchall()]
+
+
+def broadcast_set_admin_msg(job_id: int, chat_id: int, msg_id: int):
+    cur.execute("UPDATE broadcast_jobs SET admin_chat_id=?, admin_msg_id=? WHERE id=?", (chat_id, msg_id, job_id))
+
+
+def broadcast_set_status(job_id: int, status: str, from_status: tuple[str, ...] = ("running", "paused")) -> bool:
+    """Move a job to `status` if it is currently in one of `from_status`; False when it was not."""
+    ts = now_iso()
+    placeholders = ",".join("?" for _ in from_status)
+    c = cur.execute(
+        f"""
+        UPDATE broadcast_jobs SET status=?, updated_at=?,
+            finished_at=CASE WHEN ? IN ('done','cancelled') THEN ? ELSE finished_at END
+        WHERE id=? AND status IN ({placeholders})
+        """,
+        (status, ts, status, ts, job_id, *from_status),
+    )
+    return c.rowcount > 0
+
+
+def broadcast_advance(job_id: int, cursor_user_id: int, sent: int, failed: int) -> str | None:
+    """Persist progress after a chunk; returns the job's status so the runner sees pause/cancel."""
+    cur.execute(
+        "UPDATE broadcast_jobs SET cursor_user_id=?, sent=sent+?, failed=failed+?, updated_at=? WHERE id=?",
+        (cursor_user_id, sent, failed, now_iso(), job_id),
+    )
+    r = cur.execute("SELECT status FROM broadcast_jobs WHERE id=?", (job_id,)).fetchone()
+    return r["status"] if r else None
+
+
+def user_ids_after(after_id: int, limit: int) -> list[int]:
+    """One chunk of reachable user ids in id order, for streaming over the whole table."""
+    return [
+        r[0]
+        for r in cur.execute(
+            "SELECT user_id FROM users WHERE unreachable_at IS NULL AND user_id>? ORDER BY user_id LIMIT ?",
+            (after_id, limit),
+        )
     ]
-    total = cur.execute("SELECT COUNT(1) FROM ticket_messages WHERE ticket_id=?", (tid,)).fetchone()[0]
-    return rows, total
 
 
 def find_ticket_by_msg_id(tg_msg_id: int):
@@ -770,16 +1694,54 @@ def purchases_stats_range(start_iso: str, end_iso: str):
         """
         SELECT COALESCE(SUM(price),0) AS revenue, COUNT(1) AS orders, COUNT(DISTINCT user_id) AS buyers
         FROM purchases
-        WHERE created_at>=? AND created_at<?
+        WHERE created_at_ms>=? AND created_at_ms<?
         """,
-        (start_iso, end_iso),
+        (iso_to_ms(start_iso), iso_to_ms(end_iso)),
     ).fetchone()
     return {"revenue": int(row["revenue"] or 0), "orders": int(row["orders"] or 0), "buyers": int(row["buyers"] or 0)}
 
 
+def rollup_stats_range(start_day: str, end_day: str) -> dict:
+    """Totals from the daily rollups for days in [start_day, end_day] (inclusive, 'YYYY-MM-DD')."""
+    row = cur.execute(
+        """
+        SELECT COALESCE(SUM(signups),0) AS signups, COALESCE(SUM(orders),0) AS orders, COALESCE(SUM(revenue),0) AS revenue
+        FROM daily_stats WHERE day>=? AND day<=?
+        """,
+        (start_day, end_day),
+    ).fetchone()
+    buyers = cur.execute(
+        "SELECT COUNT(DISTINCT user_id) FROM daily_buyers WHERE day>=? AND day<=?",
+        (start_day, end_day),
+    ).fetchone()[0]
+    return {
+        "signups": int(row["signups"] or 0),
+        "orders": int(row["orders"] or 0),
+        "revenue": int(row["revenue"] or 0),
+        "buyers": int(buyers or 0),
+    }
+
+
+def rollup_daily_series(start_day: str, end_day: str) -> dict[str, dict]:
+    """{day: {signups, orders, revenue}} for the days in range that have any activity."""
+    rows = cur.execute(
+        "SELECT day, signups, orders, revenue FROM daily_stats WHERE day>=? AND day<=? ORDER BY day",
+        (start_day, end_day),
+    ).fetchall()
+    return {r["day"]: dict(r) for r in rows}
+
+
+def rollup_events_count(event: str, start_day: str, end_day: str) -> int:
+    row = cur.execute(
+        "SELECT COALESCE(SUM(n),0) FROM daily_events WHERE event=? AND day>=? AND day<=?",
+        (event, start_day, end_day),
+    ).fetchone()
+    return int(row[0] or 0)
+
+
 def events_count(event: str, start_iso: str, end_iso: str) -> int:
     row = cur.execute(
-        "SELECT COUNT(1) FROM events WHERE event=? AND created_at>=? AND created_at<?",
-        (event, start_iso, end_iso),
+        "SELECT COUNT(1) FROM events WHERE event=? AND created_at_ms>=? AND created_at_ms<?",
+        (event, iso_to_ms(start_iso), iso_to_ms(end_iso)),
     ).fetchone()
     return int(row[0] or 0)
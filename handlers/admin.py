@@ -1,4 +1,4 @@
-﻿import re, json, secrets, asyncio
+﻿import re, json, secrets
 import os, sqlite3, tempfile, zipfile, shutil
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -9,14 +9,19 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import StateFilter
 
-from db import is_admin, get_admin_ids, conn, is_support, is_staff
+from db import is_admin, get_admin_ids, conn, is_support, is_staff, reload_settings, event_sink, migrate
 from keyboards import kb_admin_root
+import outbound
+import broadcast
 from db import (
     cur,
     get_setting,
     set_setting,
     db_get_plan,
     db_get_plans_for_user,
+    plan_flags,
+    invalidate_plan_catalog,
+    forget_trial_status,
     user_purchases,
     cache_get_usage,
     db_get_wallet,
@@ -37,12 +42,29 @@ from db import (
     add_support,
     remove_support,
     count_users,
-    purchases_stats_range,
-    events_count,
+    keyset_result,
+    users_fts_match,
+    rollup_stats_range,
+    rollup_events_count,
+    rollup_daily_series,
+    rebuild_daily_rollups,
     get_global_discount_percent,
+    broadcast_set_status,
+    broadcast_get,
+)
+from utils import (
+    htmlesc,
+    human_bytes,
+    parse_channel_list,
+    TZ,
+    format_toman,
+    PAGE_TOKEN_RE,
+    parse_page_token,
+    membership_cache,
+    channel_details_stats,
 )
-from utils import htmlesc, human_bytes, parse_channel_list, TZ, format_toman
 from xui import three_session
+from scheduler import sync_metrics, sync_progress
 from config import THREEXUI_INBOUND_ID, PAGE_SIZE_USERS, DB_PATH
 
 router = Router()
@@ -122,6 +144,12 @@ def _restore_into_live(db_source: Path):
     with sqlite3.connect(db_source) as src:
         src.backup(conn)
     conn.commit()
+    reload_settings()
+    invalidate_plan_catalog()
+    forget_trial_status()
+    # An older backup may predate newer tables/triggers; bring it up to date and recount the rollups.
+    migrate()
+    rebuild_daily_rollups()
 
 
 @router.callback_query(F.data == "admin:backup")
@@ -287,58 +315,94 @@ def kb_reports():
             [InlineKeyboardButton(text="امروز", callback_data="admin:reports:1")],
             [InlineKeyboardButton(text="۷ روز اخیر", callback_data="admin:reports:7")],
             [InlineKeyboardButton(text="۳۰ روز اخیر", callback_data="admin:reports:30")],
+            [InlineKeyboardButton(text="🗓 بازه دلخواه", callback_data="admin:reports:custom")],
             [InlineKeyboardButton(text="⬅️ بازگشت", callback_data="admin")],
         ]
     )
 
 
 def _report_range_bounds(days: int):
-    now = datetime.now(TZ)
-    if days <= 1:
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        start = (now - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    return start, now
-
-
-@router.callback_query(F.data == "admin:reports")
-async def admin_reports(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
-    await cb.message.edit_text("بازه گزارش را انتخاب کنید:", reply_markup=kb_reports())
+    """(first_day, last_day) inclusive, as 'YYYY-MM-DD' in UTC, ending today."""
+    today = datetime.now(TZ).date()
+    start = today - timedelta(days=max(1, days) - 1)
+    return start.isoformat(), today.isoformat()
 
 
-@router.callback_query(F.data.regexp(r"^admin:reports:(1|7|30)$"))
-async def admin_reports_range(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
-    days = int(re.match(r"^admin:reports:(1|7|30)$", cb.data).group(1))
-    start, end = _report_range_bounds(days)
-    start_iso, end_iso = start.isoformat(), end.isoformat()
-    stats = purchases_stats_range(start_iso, end_iso)
+def _report_lines(label: str, start_day: str, end_day: str) -> list[str]:
+    stats = rollup_stats_range(start_day, end_day)
     revenue = stats.get("revenue", 0)
     orders = stats.get("orders", 0)
     buyers = stats.get("buyers", 0)
     aov = (revenue / orders) if orders else 0
     total_users = count_users()
     conversion = (buyers / total_users * 100) if total_users else 0
-    checkout = events_count("checkout_initiated", start_iso, end_iso)
-    success = events_count("purchase_success", start_iso, end_iso)
+    checkout = rollup_events_count("checkout_initiated", start_day, end_day)
+    success = rollup_events_count("purchase_success", start_day, end_day)
     funnel = (success / checkout * 100) if checkout else 0
-    labels = {1: "امروز", 7: "۷ روز اخیر", 30: "۳۰ روز اخیر"}
-    lines = [
-        f"🗓 بازه: {labels.get(days, days)}",
+    return [
+        f"🗓 بازه: {label}",
         f"💰 درآمد: {format_toman(revenue)}",
         f"🧾 سفارشات: {orders:,}",
         f"🛍 خریداران یونیک: {buyers:,}",
+        f"👤 کاربران جدید: {stats.get('signups', 0):,}",
         f"💳 AOV: {format_toman(int(aov))}",
         f"🎯 کانورژن ساده: {conversion:.1f}%",
         f"📊 قیف خرید: {funnel:.1f}% (purchase_success / checkout_initiated)",
         f"رویدادها: checkout_initiated={checkout:,} | purchase_success={success:,}",
     ]
+
+
+class ReportRange(StatesGroup):
+    waiting = State()
+
+
+@router.callback_query(F.data == "admin:reports")
+async def admin_reports(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
+    await cb.message.edit_text("بازه گزارش را انتخاب کنید:", reply_markup=kb_reports())
+
+
+@router.callback_query(F.data.regexp(r"^admin:reports:(1|7|30)$"))
+async def admin_reports_range(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
+    days = int(re.match(r"^admin:reports:(1|7|30)$", cb.data).group(1))
+    start_day, end_day = _report_range_bounds(days)
+    labels = {1: "امروز", 7: "۷ روز اخیر", 30: "۳۰ روز اخیر"}
+    lines = _report_lines(labels.get(days, str(days)), start_day, end_day)
     await cb.message.edit_text("\n".join(lines), reply_markup=kb_reports())
 
 
+@router.callback_query(F.data == "admin:reports:custom")
+async def admin_reports_custom(cb: CallbackQuery, state: FSMContext):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
+    await state.set_state(ReportRange.waiting)
+    await cb.message.edit_text(
+        "بازه را به شکل <code>YYYY-MM-DD YYYY-MM-DD</code> بفرستید (روز آخر هم حساب می‌شود، تاریخ‌ها UTC).",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ بازگشت", callback_data="admin:reports")]]),
+        parse_mode=ParseMode.HTML,
+    )
+
+
+@router.message(StateFilter(ReportRange.waiting))
+async def admin_reports_custom_input(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    parts = (m.text or "").split()
+    try:
+        start = datetime.strptime(parts[0], "%Y-%m-%d").date()
+        end = datetime.strptime(parts[1], "%Y-%m-%d").date() if len(parts) > 1 else start
+    except (IndexError, ValueError):
+        return await m.answer("فرمت نامعتبر است. مثال: 2024-01-01 2024-01-31")
+    if end < start:
+        start, end = end, start
+    await state.clear()
+    lines = _report_lines(f"{start.isoformat()} تا {end.isoformat()}", start.isoformat(), end.isoformat())
+    await m.answer("\n".join(lines), reply_markup=kb_reports())
+
+
 @router.callback_query(F.data == "admin:refs")
 async def admin_refs(cb: CallbackQuery):
     if not is_admin(cb.from_user.id):
@@ -490,38 +554,44 @@ async def admin_ref_save_desc(m: Message, state: FSMContext):
     await state.clear()
 
 
-def search_users_page(q: str, offset: int, limit: int):
+_USERS_SEARCH_WHERE = """
+    (lower(COALESCE(username,'')) LIKE ? OR lower(COALESCE(first_name,'')) LIKE ?
+     OR lower(COALESCE(last_name,'')) LIKE ? OR CAST(user_id AS TEXT) LIKE ?)"""
+
+
+def _users_keyset_page(where: str, params: tuple, limit: int, after_id: int | None, before_id: int | None):
+    """Users newest first, keyed on (created_at_ms, user_id); the cursor row's sort key is looked up by PK."""
+    cursor_id = before_id if before_id is not None else after_id
+    conds = [where] if where else []
+    args = list(params)
+    if cursor_id is not None:
+        op = ">" if before_id is not None else "<"
+        conds.append(f"(created_at_ms, user_id) {op} (SELECT created_at_ms, user_id FROM users WHERE user_id=?)")
+        args.append(cursor_id)
+    order = "ASC" if before_id is not None else "DESC"
+    q = "SELECT user_id,username,first_name,last_name,wallet,created_at FROM users"
+    if conds:
+        q += " WHERE " + " AND ".join(conds)
+    q += f" ORDER BY created_at_ms {order}, user_id {order} LIMIT ?"
+    args.append(limit + 1)
+    return keyset_result(cur.execute(q, args).fetchall(), limit, after_id, before_id)
+
+
+def search_users_page(q: str, limit: int, after_id: int | None = None, before_id: int | None = None):
+    match = users_fts_match(q)
+    if match:
+        where = "user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)"
+        return _users_keyset_page(where, (match,), limit, after_id, before_id)
+    # Too short for the trigram index (or FTS5 unavailable): plain scan.
     ql = f"%{q.lower()}%"
-    rows = cur.execute(
-        """
-    SELECT user_id,username,first_name,last_name,wallet,created_at FROM users
-    WHERE lower(COALESCE(username,'')) LIKE ? OR lower(COALESCE(first_name,'')) LIKE ?
-       OR lower(COALESCE(last_name,'')) LIKE ? OR CAST(user_id AS TEXT) LIKE ?
-    ORDER BY created_at DESC LIMIT ? OFFSET ?
-    """,
-        (ql, ql, ql, ql, limit, offset),
-    ).fetchall()
-    total = cur.execute(
-        """
-    SELECT COUNT(1) FROM users
-    WHERE lower(COALESCE(username,'')) LIKE ? OR lower(COALESCE(first_name,'')) LIKE ?
-       OR lower(COALESCE(last_name,'')) LIKE ? OR CAST(user_id AS TEXT) LIKE ?
-    """,
-        (ql, ql, ql, ql),
-    ).fetchone()[0]
-    return [dict(r) for r in rows], total
+    return _users_keyset_page(_USERS_SEARCH_WHERE, (ql, ql, ql, ql), limit, after_id, before_id)
 
 
-def list_users_page(offset: int, limit: int):
-    rows = cur.execute(
-        "SELECT * FROM users ORDER BY created_at DESC LIMIT ? OFFSET ?",
-        (limit, offset),
-    ).fetchall()
-    total = cur.execute("SELECT COUNT(1) FROM users").fetchone()[0]
-    return [dict(r) for r in rows], total
+def list_users_page(limit: int, after_id: int | None = None, before_id: int | None = None):
+    return _users_keyset_page("", (), limit, after_id, before_id)
 
 
-def kb_admin_users_list(rows, page: int, total: int, page_size: int, q: str | None = None):
+def kb_admin_users_list(rows, has_prev: bool, has_next: bool, q: str | None = None):
     kb = []
     for r in rows:
         name = (
@@ -542,16 +612,16 @@ def kb_admin_users_list(rows, page: int, total: int, page_size: int, q: str | No
             ]
         )
     nav = []
-    if page > 0:
+    if has_prev and rows:
         nav.append(
             InlineKeyboardButton(
-                text="قبلی", callback_data=f"admin:users:{page-1}:{q or ''}"
+                text="قبلی", callback_data=f"admin:users:b{rows[0]['user_id']}:{q or ''}"
             )
         )
-    if (page + 1) * page_size < total:
+    if has_next and rows:
         nav.append(
             InlineKeyboardButton(
-                text="بعدی", callback_data=f"admin:users:{page+1}:{q or ''}"
+                text="بعدی", callback_data=f"admin:users:a{rows[-1]['user_id']}:{q or ''}"
             )
         )
     if nav:
@@ -560,23 +630,22 @@ def kb_admin_users_list(rows, page: int, total: int, page_size: int, q: str | No
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 
-@router.callback_query(F.data.regexp(r"^admin:users:(\d+):(.*)$"))
+@router.callback_query(F.data.regexp(rf"^admin:users:({PAGE_TOKEN_RE}):(.*)$"))
 async def admin_users(cb: CallbackQuery):
     if not is_admin(cb.from_user.id):
         return await cb.answer("دسترسی غیرمجاز", show_alert=True)
-    m = re.match(r"^admin:users:(\d+):(.*)$", cb.data)
-    page = int(m.group(1))
+    m = re.match(rf"^admin:users:({PAGE_TOKEN_RE}):(.*)$", cb.data)
+    after_id, before_id = parse_page_token(m.group(1))
     q = (m.group(2) or "").strip()
     limit = PAGE_SIZE_USERS
-    offset = page * limit
     if q:
-        rows, total = search_users_page(q, offset, limit)
+        rows, has_prev, has_next = search_users_page(q, limit, after_id, before_id)
         header = f"کاربران (جستجو: {htmlesc(q)}):"
     else:
-        rows, total = list_users_page(offset, limit)
-        header = "کاربران:"
+        rows, has_prev, has_next = list_users_page(limit, after_id, before_id)
+        header = f"کاربران ({count_users()}):"
     await cb.message.edit_text(
-        header, reply_markup=kb_admin_users_list(rows, page, total, limit, q)
+        header, reply_markup=kb_admin_users_list(rows, has_prev, has_next, q)
     )
 
 
@@ -592,6 +661,8 @@ async def _render_admin_user_detail(cb: CallbackQuery, uid: int):
         f"موجودی فعلی: {format_toman(u['wallet'])}\n"
         f"تاریخ عضویت: {u['created_at'][:19].replace('T',' ')}"
     )
+    if u["unreachable_at"]:
+        text += f"\n⛔️ غیرقابل دسترس (ربات مسدود/حساب حذف شده) از {u['unreachable_at'][:19].replace('T',' ')}"
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="خریدها", callback_data=f"admin:u:buys:{uid}")],
@@ -770,12 +841,9 @@ async def admin_plan_add_recv(m: Message, state: FSMContext):
 
 
 def kb_plan_detail(p: dict):
-    try:
-        flags = json.loads(p.get("flags") or "{}")
-    except Exception:
-        flags = {}
-    admin_only = bool(flags.get("admin_only"))
-    test = bool(flags.get("test"))
+    flags = plan_flags(p)
+    admin_only = flags.admin_only
+    test = flags.test
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
@@ -1329,8 +1397,12 @@ async def admin_paneltest(cb: CallbackQuery):
         )
     try:
         ibs = await three_session.list_inbounds()
+        trips = [
+            f"{op}: calls={calls} round-trips={rt}" + (f" ({rt / calls:.1f}/call)" if calls else "")
+            for op, (calls, rt) in three_session.roundtrip_stats().items()
+        ]
         await cb.message.edit_text(
-            f"Panel reachable. Inbounds: {len(ibs)}",
+            f"Panel reachable. Inbounds: {len(ibs)}" + ("\n\n" + "\n".join(trips) if trips else ""),
             reply_markup=InlineKeyboardMarkup(
                 inline_keyboard=[[InlineKeyboardButton(text="بازگشت ⬅️", callback_data="admin")]]
             ),
@@ -1344,6 +1416,59 @@ async def admin_paneltest(cb: CallbackQuery):
         )
 
 
+def _fmt_sync_line(m: dict) -> str:
+    line = (
+        f"total={m.get('total', 0)} done={m.get('done', 0)} written={m.get('written', 0)} missing={m.get('missing', 0)} "
+        f"failed={m.get('failed', 0)} timed_out={m.get('timed_out', 0)}"
+    )
+    if "queued" in m:
+        line += f" queued={m['queued']}"
+    if "duration" in m:
+        line += f" | {m['duration']}s"
+    return line
+
+
+@router.callback_query(F.data == "admin:metrics")
+async def admin_metrics(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
+    lines = ["<b>📟 وضعیت سیستم</b>", ""]
+    if sync_progress and "duration" not in sync_progress:
+        lines.append(f"🔄 همگام‌سازی در حال اجرا ({htmlesc(sync_progress.get('started_at', ''))[:19]}):")
+        lines.append(_fmt_sync_line(sync_progress))
+    if sync_metrics:
+        lines.append(f"✅ آخرین همگام‌سازی ({htmlesc(sync_metrics.get('started_at', ''))[:19]}):")
+        lines.append(_fmt_sync_line(sync_metrics))
+    else:
+        lines.append("همگام‌سازی هنوز اجرا نشده است.")
+    lines.append("")
+    lines.append(f"رویدادهای بافر: queued={len(event_sink)} flushed={event_sink.flushed} dropped={event_sink.dropped}")
+    ob = outbound.dispatcher.stats()
+    lines.append(
+        f"ارسال پیام: sent={ob['sent']} failed={ob['failed']} unreachable={ob['unreachable']} flood-retries={ob['retried']} "
+        f"queue high/normal/bulk={ob['queued_high']}/{ob['queued_normal']}/{ob['queued_bulk']}"
+    )
+    mc = membership_cache.stats()
+    lines.append(
+        f"کش عضویت کانال: hits={mc['hits']} misses={mc['misses']} hit-rate={mc['hit_rate']:.0%} "
+        f"invalidations={mc['invalidations']} users={mc['users']} | "
+        f"channel info hits/misses={channel_details_stats['hits']}/{channel_details_stats['misses']}"
+    )
+    if three_session:
+        lines.append("")
+        lines.append("3x-ui round-trips:")
+        for op, (calls, rt) in three_session.roundtrip_stats().items():
+            lines.append(f"{op}: calls={calls} round-trips={rt}")
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 بروزرسانی", callback_data="admin:metrics")],
+            [InlineKeyboardButton(text="⬅️ بازگشت", callback_data="admin")],
+        ]
+    )
+    try:
+        await cb.message.edit_text("\n".join(lines), reply_markup=kb, parse_mode=ParseMode.HTML)
+    except Exception:
+        await cb.answer("بدون تغییر")
 
 
 # --- Admins management ---
@@ -1403,27 +1528,15 @@ async def admin_admins_remove(cb:CallbackQuery):
 async def admin_dashboard(cb:CallbackQuery):
     if not is_admin(cb.from_user.id):
         return await cb.answer("دسترسی غیرمجاز", show_alert=True)
-    # Users stats (last 7 days)
-    import datetime as dt
-    from collections import Counter
-    rows = cur.execute("SELECT created_at FROM users").fetchall()
-    days = [(str(r[0])[:10]) for r in rows]
-    cnt = Counter(days)
-    today = dt.date.today()
-    labels = []
-    values = []
-    for i in range(6,-1,-1):
-        d = (today - dt.timedelta(days=i)).isoformat()
-        labels.append(d[5:])
-        values.append(cnt.get(d,0))
-    total_users = cur.execute("SELECT COUNT(1) FROM users").fetchone()[0]
+    # Users / purchases stats (last 7 days) from the daily rollups
+    today = datetime.now(TZ).date()
+    days = [(today - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
+    series = rollup_daily_series(days[0], days[-1])
+    labels = [d[5:] for d in days]
+    values = [int(series.get(d, {}).get("signups") or 0) for d in days]
+    total_users = count_users()
     # خریدها last 7 days
-    rows2 = cur.execute("SELECT created_at FROM purchases").fetchall()
-    days2 = [(str(r[0])[:10]) for r in rows2]
-    cnt2 = Counter(days2)
-    pvals = []
-    for i in range(6,-1,-1):
-        d=(today-dt.timedelta(days=i)).isoformat(); pvals.append(cnt2.get(d,0))
+    pvals = [int(series.get(d, {}).get("orders") or 0) for d in days]
     # Top consumers
     top = cur.execute("""
         SELECT p.user_id, COALESCE(SUM(c.up + c.down),0) AS used
@@ -1499,7 +1612,7 @@ async def admin_broadcast_send_template(cb: CallbackQuery):
     if not template_text:
         await cb.answer("قالب یافت نشد.", show_alert=True)
         return
-    asyncio.create_task(_send_broadcast(cb.bot, template_text, cb.from_user.id))
+    await broadcast.start(cb.bot, template_text, cb.from_user.id, cb.message.chat.id)
     await cb.answer("پیام همگانی در حال ارسال است.")
 
 
@@ -1511,21 +1624,28 @@ async def admin_broadcast_send_custom(m: Message, state: FSMContext):
     text = m.html_text or m.text or ""
     if not text.strip():
         return await m.reply("پیام نمی‌تواند خالی باشد.")
-    asyncio.create_task(_send_broadcast(m.bot, text, m.from_user.id))
     await state.clear()
-    await m.reply("پیام همگانی در حال ارسال است.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ بازگشت", callback_data="admin:broadcast")]]))
+    await broadcast.start(m.bot, text, m.from_user.id, m.chat.id)
 
 
-async def _send_broadcast(bot, message_text: str, sender_id: int):
-    users = cur.execute("SELECT user_id FROM users").fetchall()
-    sent = 0
-    failed = 0
-    for r in users:
-        uid = r["user_id"]
-        try:
-            await bot.send_message(uid, message_text, parse_mode=ParseMode.HTML)
-            sent += 1
-        except Exception:
-            failed += 1
-        await asyncio.sleep(0.05)
-    log_evt(sender_id, "broadcast", {"sent": sent, "failed": failed, "message": message_text[:200]})
+@router.callback_query(F.data.regexp(r"^admin:bc:(pause|resume|cancel|view):(\d+)$"))
+async def admin_broadcast_control(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer("دسترسی غیرمجاز", show_alert=True)
+    _, _, action, job_id = cb.data.split(":")
+    job_id = int(job_id)
+    if action == "pause":
+        ok = broadcast_set_status(job_id, "paused", ("running",))
+    elif action == "resume":
+        ok = broadcast_set_status(job_id, "running", ("paused",))
+        if ok:
+            broadcast.resume(cb.bot, job_id)
+    elif action == "cancel":
+        ok = broadcast_set_status(job_id, "cancelled")
+        if ok:
+            job = broadcast_get(job_id)
+            log_evt(cb.from_user.id, "broadcast", broadcast.audit_meta(job))
+    else:
+        ok = True
+    await broadcast.show_progress(cb.bot, job_id)
+    await cb.answer("انجام شد." if ok else "وضعیت این ارسال تغییر کرده است.")
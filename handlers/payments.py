@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
@@ -19,10 +20,12 @@ from db import (
     db_add_wallet,
     db_update_payment_status,
     db_list_pending_payments_page,
+    get_counter,
     get_setting,
 )
-from utils import htmlesc, format_toman
+from utils import htmlesc, format_toman, PAGE_TOKEN_RE, parse_page_token
 import json, re
+import outbound
 
 router = Router()
 logger = logging.getLogger("pingx.payments")
@@ -114,8 +117,8 @@ async def _send_media(bot, chat_id, media, *, caption=None, parse_mode=None, rep
     if not fid:
         return None
     if kind == "document":
-        return await bot.send_document(chat_id, fid, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
-    return await bot.send_photo(chat_id, fid, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
+        return await outbound.send(bot.send_document, chat_id, fid, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
+    return await outbound.send(bot.send_photo, chat_id, fid, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
 
 
 async def _submit_topup_request(bot, user, amount, media, notes):
@@ -151,14 +154,12 @@ async def _submit_topup_request(bot, user, amount, media, notes):
                     markup = action_kb if idx == 0 else None
                     await _send_media(bot, target_id, item, caption=caption, parse_mode=ParseMode.HTML, reply_markup=markup)
             else:
-                await bot.send_message(target_id, summary, parse_mode=ParseMode.HTML, reply_markup=action_kb)
+                await outbound.send(bot.send_message, target_id, summary, parse_mode=ParseMode.HTML, reply_markup=action_kb)
         except Exception:
             logger.warning("Send receipt notify failed chat=%s pid=%s", target_id, pid, exc_info=True)
 
-    for rid in recipients:
-        await _send_to(rid)
-    if target_group:
-        await _send_to(target_group)
+    # Fan out concurrently; the outbound dispatcher paces the actual sends.
+    await asyncio.gather(*(_send_to(rid) for rid in [*recipients, *([target_group] if target_group else [])]))
     return pid, note_txt
 
 
@@ -335,27 +336,25 @@ def _topup_main_keyboard():
     )
 
 
-@router.callback_query(F.data.regexp(r"^admin:pending:(\d+)$"))
+@router.callback_query(F.data.regexp(rf"^admin:pending:({PAGE_TOKEN_RE})$"))
 async def admin_pending(cb: CallbackQuery):
     if not is_staff(cb.from_user.id):
         return await cb.answer("دسترسی غیرمجاز است", show_alert=True)
-    page = int(re.match(r"^admin:pending:(\d+)$", cb.data).group(1))
-    size = PAGE_SIZE_PAYMENTS
-    off = page * size
-    rows, total = db_list_pending_payments_page(off, size)
+    after_id, before_id = parse_page_token(re.match(rf"^admin:pending:({PAGE_TOKEN_RE})$", cb.data).group(1))
+    rows, has_prev, has_next = db_list_pending_payments_page(PAGE_SIZE_PAYMENTS, after_id, before_id)
     kb_rows = []
     for r in rows:
         kb_rows.append([InlineKeyboardButton(text=f"#{r['id']} مبلغ {format_toman(r['amount'])}", callback_data=f"payview:{r['id']}")])
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton(text="⬅️ قبلی", callback_data=f"admin:pending:{page-1}"))
-    if off + size < total:
-        nav.append(InlineKeyboardButton(text="صفحه بعد ➡️", callback_data=f"admin:pending:{page+1}"))
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="⬅️ قبلی", callback_data=f"admin:pending:b{rows[0]['id']}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="صفحه بعد ➡️", callback_data=f"admin:pending:a{rows[-1]['id']}"))
     if nav:
         kb_rows.append(nav)
     kb_rows.append([InlineKeyboardButton(text="↩️ بازگشت", callback_data="admin")])
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-    await cb.message.edit_text("پرداخت‌های در انتظار بررسی:", reply_markup=kb)
+    await cb.message.edit_text(f"پرداخت‌های در انتظار بررسی ({get_counter('payments_pending')}):", reply_markup=kb)
 
 
 def _kb_payment_actions(pid: int, include_back: bool = True):
@@ -431,7 +430,12 @@ async def admin_pay_ok(cb: CallbackQuery):
     db_update_payment_status(pid, "approved")
     logger.info("Topup approved pid=%s uid=%s amount=%s by_admin=%s", pid, r["user_id"], r["amount"], cb.from_user.id)
     try:
-        await cb.bot.send_message(r["user_id"], f"پرداخت شما به مبلغ {format_toman(r['amount'])} تایید شد و به کیف پولتان اضافه شد.")
+        await outbound.send(
+            cb.bot.send_message,
+            r["user_id"],
+            f"پرداخت شما به مبلغ {format_toman(r['amount'])} تایید شد و به کیف پولتان اضافه شد.",
+            priority=outbound.HIGH,
+        )
     except Exception:
         pass
     actor_label = cb.from_user.full_name or cb.from_user.username or cb.from_user.id
@@ -456,7 +460,12 @@ async def admin_pay_no(cb: CallbackQuery):
         return await cb.answer("این پرداخت قبلاً رد شده است.", show_alert=True)
     db_update_payment_status(pid, "rejected")
     try:
-        await cb.bot.send_message(r["user_id"], "پرداخت شما تایید نشد. لطفاً مجدد ارسال کنید یا با پشتیبانی در تماس باشید.")
+        await outbound.send(
+            cb.bot.send_message,
+            r["user_id"],
+            "پرداخت شما تایید نشد. لطفاً مجدد ارسال کنید یا با پشتیبانی در تماس باشید.",
+            priority=outbound.HIGH,
+        )
     except Exception:
         pass
     actor_label = cb.from_user.full_name or cb.from_user.username or cb.from_user.id
@@ -1,3 +1,4 @@
+import asyncio
 import re
 from aiogram import Router, F
 from aiogram.enums import ParseMode
@@ -18,10 +19,12 @@ from db import (
     list_tickets_page,
     list_ticket_messages_page,
     find_ticket_by_msg_id,
+    get_counter,
     cur,
 )
-from utils import htmlesc, format_identity
+from utils import htmlesc, format_identity, PAGE_TOKEN_RE, parse_page_token
 from config import PAGE_SIZE_TICKETS, TICKET_GROUP_ID
+import outbound
 
 router = Router()
 
@@ -105,21 +108,22 @@ async def _forward_user_ticket_message(m: Message, tid: int):
     recipients = list(get_admin_ids().union(get_support_ids()))
     if TICKET_GROUP_ID:
         recipients.append(TICKET_GROUP_ID)
-    for aid in recipients:
+
+    async def _send_to(aid):
         try:
             sent = None
             if m.photo:
-                sent = await m.bot.send_photo(aid, m.photo[-1].file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
+                sent = await outbound.send(m.bot.send_photo, aid, m.photo[-1].file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
             elif m.document:
-                sent = await m.bot.send_document(aid, m.document.file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
+                sent = await outbound.send(m.bot.send_document, aid, m.document.file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
             elif m.voice:
-                sent = await m.bot.send_voice(aid, m.voice.file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
+                sent = await outbound.send(m.bot.send_voice, aid, m.voice.file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
             elif m.video:
-                sent = await m.bot.send_video(aid, m.video.file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
+                sent = await outbound.send(m.bot.send_video, aid, m.video.file_id, caption=header, reply_markup=kb, parse_mode=ParseMode.HTML)
             elif m.sticker:
-                sent = await m.bot.send_sticker(aid, m.sticker.file_id)
+                sent = await outbound.send(m.bot.send_sticker, aid, m.sticker.file_id)
             else:
-                sent = await m.bot.send_message(aid, f"{header}:\n{htmlesc(m.text or '').strip()}", reply_markup=kb, parse_mode=ParseMode.HTML)
+                sent = await outbound.send(m.bot.send_message, aid, f"{header}:\n{htmlesc(m.text or '').strip()}", reply_markup=kb, parse_mode=ParseMode.HTML)
             if msg_db_id and sent:
                 try:
                     if aid == TICKET_GROUP_ID:
@@ -131,6 +135,9 @@ async def _forward_user_ticket_message(m: Message, tid: int):
         except Exception:
             pass
 
+    # Fan out concurrently; the outbound dispatcher paces the actual sends.
+    await asyncio.gather(*(_send_to(aid) for aid in recipients))
+
 
 @router.callback_query(F.data == "support")
 async def user_support(cb: CallbackQuery, state: FSMContext):
@@ -145,7 +152,8 @@ async def user_support(cb: CallbackQuery, state: FSMContext):
         recipients.append(TICKET_GROUP_ID)
     for aid in recipients:
         try:
-            await cb.bot.send_message(
+            await outbound.send(
+                cb.bot.send_message,
                 aid,
                 f"🆘 تیکت #{tid} از <a href=\"tg://user?id={cb.from_user.id}\">{htmlesc(cb.from_user.full_name or cb.from_user.username or cb.from_user.id)}</a>",
                 parse_mode=ParseMode.HTML,
@@ -171,7 +179,7 @@ async def user_ticket_close(cb: CallbackQuery, state: FSMContext):
     ticket_close(row["id"])
     for aid in get_admin_ids():
         try:
-            await cb.bot.send_message(aid, f"تیکت #{row['id']} توسط کاربر بسته شد.")
+            await outbound.send(cb.bot.send_message, aid, f"تیکت #{row['id']} توسط کاربر بسته شد.")
         except Exception:
             pass
     await state.clear()
@@ -243,12 +251,12 @@ async def user_ticket_pipeline(m: Message):
 # --- Admin side ---
 
 
-@router.callback_query(F.data.regexp(r"^admin:tickets:(\d+)$"))
+@router.callback_query(F.data.regexp(rf"^admin:tickets:({PAGE_TOKEN_RE})$"))
 async def admin_tickets_list(cb: CallbackQuery):
     if not is_staff(cb.from_user.id):
         return await cb.answer("دسترسی غیرمجاز است", show_alert=True)
-    page = int(re.match(r"^admin:tickets:(\d+)$", cb.data).group(1))
-    rows, total = list_tickets_page(page, PAGE_SIZE_TICKETS)
+    after_id, before_id = parse_page_token(re.match(rf"^admin:tickets:({PAGE_TOKEN_RE})$", cb.data).group(1))
+    rows, has_prev, has_next = list_tickets_page(PAGE_SIZE_TICKETS, after_id, before_id)
     lines = []
     kb = []
     for r in rows:
@@ -257,24 +265,24 @@ async def admin_tickets_list(cb: CallbackQuery):
         lines.append(f"#T{r['id']} | UID:{r.get('user_id')} | {mention} | {r['status']}")
         kb.append([InlineKeyboardButton(text=f"#T{r['id']} | UID:{r.get('user_id')} | {r['status']}", callback_data=f"adm:tkt:view:{r['id']}:0")])
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton(text="⬅️ قبلی", callback_data=f"admin:tickets:{page-1}"))
-    if (page + 1) * PAGE_SIZE_TICKETS < total:
-        nav.append(InlineKeyboardButton(text="صفحه بعد ➡️", callback_data=f"admin:tickets:{page+1}"))
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="⬅️ قبلی", callback_data=f"admin:tickets:b{rows[0]['id']}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="صفحه بعد ➡️", callback_data=f"admin:tickets:a{rows[-1]['id']}"))
     if nav:
         kb.append(nav)
     kb.append([InlineKeyboardButton(text="↩️ بازگشت", callback_data="admin")])
-    body = "تیکت‌ها:\n" + ("\n".join(lines) if lines else "موردی نیست.")
+    body = f"تیکت‌ها ({get_counter('tickets')}):\n" + ("\n".join(lines) if lines else "موردی نیست.")
     await cb.message.edit_text(body, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb), parse_mode=ParseMode.HTML)
 
 
-@router.callback_query(F.data.regexp(r"^adm:tkt:view:(\d+):(\d+)$"))
+@router.callback_query(F.data.regexp(rf"^adm:tkt:view:(\d+):({PAGE_TOKEN_RE})$"))
 async def admin_ticket_view(cb: CallbackQuery):
     if not is_staff(cb.from_user.id):
         return await cb.answer("دسترسی غیرمجاز است", show_alert=True)
-    m = re.match(r"^adm:tkt:view:(\d+):(\d+)$", cb.data)
+    m = re.match(rf"^adm:tkt:view:(\d+):({PAGE_TOKEN_RE})$", cb.data)
     tid = int(m.group(1))
-    page = int(m.group(2))
+    after_id, before_id = parse_page_token(m.group(2))
     size = 10
     ticket_row = cur.execute(
         "SELECT t.user_id,t.status,u.username,u.first_name,u.last_name FROM tickets t LEFT JOIN users u ON u.user_id=t.user_id WHERE t.id=?",
@@ -289,7 +297,7 @@ async def admin_ticket_view(cb: CallbackQuery):
         ln = ticket_row["last_name"] or ""
         full_name = (fn + " " + ln).strip() or None
     mention = format_identity(uid, username, full_name or str(uid))
-    rows, total = list_ticket_messages_page(tid, page, size)
+    rows, has_prev, has_next = list_ticket_messages_page(tid, size, after_id, before_id)
     header = f"#T{tid} | UID:{uid} | کاربر: {mention} | وضعیت: {status}"
     if not rows:
         text = header + "\nپیامی در این صفحه نیست."
@@ -302,10 +310,10 @@ async def admin_ticket_view(cb: CallbackQuery):
         text = header + "\n" + "\n".join(lines)
     kb = []
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton(text="⬅️ قبلی", callback_data=f"adm:tkt:view:{tid}:{page-1}"))
-    if (page + 1) * size < total:
-        nav.append(InlineKeyboardButton(text="صفحه بعد ➡️", callback_data=f"adm:tkt:view:{tid}:{page+1}"))
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="⬅️ قبلی", callback_data=f"adm:tkt:view:{tid}:b{rows[0]['id']}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="صفحه بعد ➡️", callback_data=f"adm:tkt:view:{tid}:a{rows[-1]['id']}"))
     if nav:
         kb.append(nav)
     kb.append(
@@ -347,7 +355,7 @@ async def admin_ticket_close(cb: CallbackQuery):
     ticket_close(tid)
     try:
         if row and row["user_id"]:
-            await cb.bot.send_message(row["user_id"], f"تیکت #{tid} توسط ادمین بسته شد.")
+            await outbound.send(cb.bot.send_message, row["user_id"], f"تیکت #{tid} توسط ادمین بسته شد.")
     except Exception:
         pass
     await cb.answer("بسته شد.")
@@ -386,7 +394,7 @@ async def admin_reply_dispatch(m: Message, state: FSMContext):
     ticket_set_activity(tid)
     try:
         if m.photo:
-            sent = await m.bot.send_photo(uid, m.photo[-1].file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_photo, uid, m.photo[-1].file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -399,7 +407,7 @@ async def admin_reply_dispatch(m: Message, state: FSMContext):
                 src_message_id=m.message_id,
             )
         elif m.document:
-            sent = await m.bot.send_document(uid, m.document.file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_document, uid, m.document.file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -412,7 +420,7 @@ async def admin_reply_dispatch(m: Message, state: FSMContext):
                 src_message_id=m.message_id,
             )
         elif m.voice:
-            sent = await m.bot.send_voice(uid, m.voice.file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_voice, uid, m.voice.file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -425,7 +433,7 @@ async def admin_reply_dispatch(m: Message, state: FSMContext):
                 src_message_id=m.message_id,
             )
         elif m.video:
-            sent = await m.bot.send_video(uid, m.video.file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_video, uid, m.video.file_id, caption=m.caption or "", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -438,7 +446,7 @@ async def admin_reply_dispatch(m: Message, state: FSMContext):
                 src_message_id=m.message_id,
             )
         elif m.sticker:
-            sent = await m.bot.send_sticker(uid, m.sticker.file_id)
+            sent = await outbound.send(m.bot.send_sticker, uid, m.sticker.file_id)
             store_tmsg(
                 tid,
                 "admin",
@@ -451,7 +459,7 @@ async def admin_reply_dispatch(m: Message, state: FSMContext):
                 src_message_id=m.message_id,
             )
         else:
-            sent = await m.bot.send_message(uid, m.text or "", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_message, uid, m.text or "", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -487,7 +495,7 @@ async def group_ticket_reply(m: Message):
     prefix = f"پاسخ پشتیبانی به تیکت #{tid}:"
     try:
         if m.photo:
-            sent = await m.bot.send_photo(uid, m.photo[-1].file_id, caption=f"{prefix}\n{m.caption or ''}", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_photo, uid, m.photo[-1].file_id, caption=f"{prefix}\n{m.caption or ''}", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -500,7 +508,7 @@ async def group_ticket_reply(m: Message):
                 src_message_id=m.message_id,
             )
         elif m.document:
-            sent = await m.bot.send_document(uid, m.document.file_id, caption=f"{prefix}\n{m.caption or ''}", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_document, uid, m.document.file_id, caption=f"{prefix}\n{m.caption or ''}", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -513,7 +521,7 @@ async def group_ticket_reply(m: Message):
                 src_message_id=m.message_id,
             )
         elif m.voice:
-            sent = await m.bot.send_voice(uid, m.voice.file_id, caption=prefix, reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_voice, uid, m.voice.file_id, caption=prefix, reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -526,7 +534,7 @@ async def group_ticket_reply(m: Message):
                 src_message_id=m.message_id,
             )
         elif m.video:
-            sent = await m.bot.send_video(uid, m.video.file_id, caption=f"{prefix}\n{m.caption or ''}", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_video, uid, m.video.file_id, caption=f"{prefix}\n{m.caption or ''}", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -539,7 +547,7 @@ async def group_ticket_reply(m: Message):
                 src_message_id=m.message_id,
             )
         elif m.sticker:
-            sent = await m.bot.send_sticker(uid, m.sticker.file_id)
+            sent = await outbound.send(m.bot.send_sticker, uid, m.sticker.file_id)
             store_tmsg(
                 tid,
                 "admin",
@@ -553,7 +561,7 @@ async def group_ticket_reply(m: Message):
             )
         else:
             text = m.text or m.caption or ""
-            sent = await m.bot.send_message(uid, f"{prefix}\n{text}", reply_markup=kb_user_reply(tid))
+            sent = await outbound.send(m.bot.send_message, uid, f"{prefix}\n{text}", reply_markup=kb_user_reply(tid))
             store_tmsg(
                 tid,
                 "admin",
@@ -6,20 +6,20 @@ from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 from aiogram import Router, F
-from aiogram.enums import ParseMode, ChatMemberStatus
+from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, CallbackQuery, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, ChatMemberUpdated
 from aiogram.filters import StateFilter
 from aiogram.exceptions import TelegramBadRequest
 
 from config import THREEXUI_INBOUND_ID, SUB_PATH, SUB_PORT, SUB_SCHEME, SUB_HOST, REQUIRED_CHANNEL
 from db import (
-    save_or_update_user,
     db_get_wallet,
-    db_get_plans_for_user,
     db_get_plan,
+    plan_catalog,
+    plan_flags,
     try_deduct_wallet,
     rollback_wallet,
     db_new_purchase,
@@ -36,10 +36,10 @@ from db import (
     get_global_discount_percent,
     log_event,
     user_has_test_purchase,
-    inc_referral_click,
-    inc_referral_signup,
 )
-from keyboards import kb_main, kb_force_join, kb_plans, kb_mysubs, kb_sub_detail
+import adb
+import outbound
+from keyboards import kb_main, kb_force_join, kb_plans_cached, kb_mysubs, kb_sub_detail
 from utils import (
     htmlesc,
     progress_bar,
@@ -48,6 +48,8 @@ from utils import (
     safe_name_from_user,
     parse_channel_list,
     fetch_channel_details,
+    missing_channels,
+    membership_cache,
     format_toman,
 )
 from xui import three_session
@@ -62,13 +64,6 @@ class Topup(StatesGroup):
     note = State()
 
 
-def _plan_flags(plan) -> dict:
-    try:
-        return json.loads(plan.get("flags") or "{}")
-    except Exception:
-        return {}
-
-
 def _apply_discount(price: int) -> tuple[int, int]:
     pct = get_global_discount_percent()
     final = price
@@ -82,15 +77,19 @@ def _kb_main_for(uid: int):
 
 
 async def _deliver_subscription_link(bot, uid: int, link: str):
-    await bot.send_photo(
+    await outbound.send(
+        bot.send_photo,
         uid,
         BufferedInputFile(qr_bytes(link).getvalue(), filename="pingx.png"),
         caption="🔗 QR و لینک اشتراک شما:",
+        priority=outbound.HIGH,
     )
-    await bot.send_message(
+    await outbound.send(
+        bot.send_message,
         uid,
         f"<a href=\"{htmlesc(link)}\">مشاهده لینک</a>\n<code>{link}</code>",
         parse_mode=ParseMode.HTML,
+        priority=outbound.HIGH,
     )
 
 
@@ -165,15 +164,14 @@ async def check_force_join(bot, uid: int) -> bool:
     channels = _required_channels_list()
     if not channels:
         return True
-    for ch in channels:
-        try:
-            cm = await bot.get_chat_member(ch, uid)
-            status = getattr(cm, "status", None)
-            if status not in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR):
-                return False
-        except Exception:
-            return False
-    return True
+    return not await missing_channels(bot, channels, uid)
+
+
+@router.chat_member()
+async def on_channel_member(update: ChatMemberUpdated):
+    # Delivered for channels where the bot is an admin: a join or leave there is reflected
+    # on the user's next update instead of after the membership cache TTL.
+    membership_cache.invalidate_user(update.new_chat_member.user.id)
 
 
 async def _force_join_message(bot):
@@ -198,18 +196,18 @@ async def start(m: Message):
     if ref_param:
         ref_code = ref_param.replace("ref-", "", 1) if ref_param.startswith("ref-") else ref_param
         if ref_code:
-            inc_referral_click(ref_code)
-    existed = cur.execute("SELECT 1 FROM users WHERE user_id=?", (m.from_user.id,)).fetchone() is not None
-    save_or_update_user(m.from_user)
+            await adb.inc_referral_click(ref_code)
+    existed = await adb.fetchone("SELECT 1 FROM users WHERE user_id=?", (m.from_user.id,)) is not None
+    await adb.save_or_update_user(m.from_user)
     if ref_code and not existed:
-        inc_referral_signup(ref_code, m.from_user)
+        await adb.inc_referral_signup(ref_code, m.from_user)
     log_event(m.from_user.id, "start", {})
     if not await check_force_join(m.bot, m.from_user.id):
         text, markup = await _force_join_message(m.bot)
         await m.answer(text, reply_markup=markup)
         return
-    bal = db_get_wallet(m.from_user.id)
-    welcome = get_setting("WELCOME_TEMPLATE", "👋 به پینگ‌ایکس خوش آمدی!")
+    bal = await adb.db_get_wallet(m.from_user.id)
+    welcome = await adb.get_setting("WELCOME_TEMPLATE", "👋 به پینگ‌ایکس خوش آمدی!")
     await m.answer(
         welcome + f"\n\n💰 موجودی کیف پول: <b>{format_toman(bal)}</b>",
         reply_markup=_kb_main_for(m.from_user.id),
@@ -221,8 +219,8 @@ async def start(m: Message):
 async def home(cb: CallbackQuery):
     if getattr(cb.message.chat, "type", "private") != "private":
         return
-    bal = db_get_wallet(cb.from_user.id)
-    welcome = get_setting("WELCOME_TEMPLATE", "👋 به پینگ‌ایکس خوش آمدی!")
+    bal = await adb.db_get_wallet(cb.from_user.id)
+    welcome = await adb.get_setting("WELCOME_TEMPLATE", "👋 به پینگ‌ایکس خوش آمدی!")
     await cb.message.edit_text(
         welcome + f"\n\n💰 موجودی کیف پول: <b>{format_toman(bal)}</b>",
         reply_markup=_kb_main_for(cb.from_user.id),
@@ -233,12 +231,11 @@ async def home(cb: CallbackQuery):
 @router.callback_query(F.data == "buy")
 async def buy_menu(cb: CallbackQuery):
     is_adm = is_admin(cb.from_user.id)
-    plans = db_get_plans_for_user(is_adm)
-    if user_has_test_purchase(cb.from_user.id) and not is_adm:
-        plans = [p for p in plans if not _plan_flags(p).get("test")]
+    trial_ok = is_adm or not user_has_test_purchase(cb.from_user.id)
     discount_pct = get_global_discount_percent()
     log_event(cb.from_user.id, "view_plans", {"discount_pct": discount_pct})
-    await cb.message.edit_text("🎯 یکی از پلن‌های زیر را انتخاب کن:", reply_markup=kb_plans(plans, is_adm, discount_pct))
+    kb = kb_plans_cached(plan_catalog(), is_adm, discount_pct, trial_ok)
+    await cb.message.edit_text("🎯 یکی از پلن‌های زیر را انتخاب کن:", reply_markup=kb)
 
 
 @router.callback_query(F.data.startswith("plan:"))
@@ -247,8 +244,8 @@ async def plan_select(cb: CallbackQuery):
     plan = db_get_plan(pid)
     if not plan:
         return await cb.answer("پلن پیدا نشد")
-    flags = _plan_flags(plan)
-    if flags.get("test") and not is_admin(cb.from_user.id) and user_has_test_purchase(cb.from_user.id):
+    flags = plan_flags(plan)
+    if flags.test and not is_admin(cb.from_user.id) and user_has_test_purchase(cb.from_user.id):
         return await cb.answer("شما قبلا پلن آزمایشی دریافت کرده‌ای.", show_alert=True)
     orig_price = int(plan["price"])
     price, discount_pct = _apply_discount(orig_price)
@@ -291,8 +288,8 @@ async def buy_confirm(cb: CallbackQuery):
     plan = db_get_plan(pid)
     if not plan:
         return await cb.answer("پلن پیدا نشد")
-    flags = _plan_flags(plan)
-    if flags.get("test") and not is_admin(cb.from_user.id) and user_has_test_purchase(cb.from_user.id):
+    flags = plan_flags(plan)
+    if flags.test and not is_admin(cb.from_user.id) and user_has_test_purchase(cb.from_user.id):
         return await cb.answer("شما قبلا پلن آزمایشی دریافت کرده‌ای.", show_alert=True)
     orig_price = int(plan["price"])
     price, discount_pct = _apply_discount(orig_price)
@@ -316,8 +313,8 @@ async def buy_confirm(cb: CallbackQuery):
     uniq = secrets.token_hex(2)
     email = f"{name_part}-{plan_slug}-{uniq}@{domain_part}"
     remark = f"{(cb.from_user.full_name or cb.from_user.username or cb.from_user.id)} | {plan['title']} | {cb.from_user.id}"
-    device_limit = int(flags.get("device_limit") or 0)
-    meta_value = {"test": True} if flags.get("test") else {}
+    device_limit = flags.device_limit
+    meta_value = {"test": True} if flags.test else {}
     now_ms = int(datetime.now(TZ).timestamp() * 1000)
     active_purchase = get_active_purchase_for_inbound(cb.from_user.id, inbound_id, now_ms)
     sub_link = None
@@ -415,10 +412,12 @@ async def buy_confirm(cb: CallbackQuery):
             reply_markup=_kb_main_for(cb.from_user.id),
         )
     except Exception:
-        await cb.bot.send_message(
+        await outbound.send(
+            cb.bot.send_message,
             cb.from_user.id,
             success_text,
             reply_markup=_kb_main_for(cb.from_user.id),
+            priority=outbound.HIGH,
         )
 
 
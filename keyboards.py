@@ -43,10 +43,7 @@ def kb_plans(plans, is_admin: bool, discount_pct: int = 0):
     except Exception:
         pct = 0
     for p in plans:
-        import json
-
-        flags = json.loads(p.get("flags") or "{}")
-        if flags.get("admin_only") and not is_admin:
+        if p["plan_flags"].admin_only and not is_admin:
             continue
         price = int(p.get("price") or 0)
         final_price = int(price * (100 - pct) / 100) if pct > 0 else price
@@ -65,6 +62,20 @@ def kb_plans(plans, is_admin: bool, discount_pct: int = 0):
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+# Built buy menus: (is_admin, discount %, trial eligible) -> (catalog version, markup).
+_plans_kb_cache: dict[tuple, tuple[int, InlineKeyboardMarkup]] = {}
+
+
+def kb_plans_cached(catalog, is_admin: bool, discount_pct: int, trial_ok: bool) -> InlineKeyboardMarkup:
+    """kb_plans over a db.PlanCatalog, rebuilt only when the catalog version or the key changes."""
+    key = (bool(is_admin), int(discount_pct or 0), bool(trial_ok))
+    hit = _plans_kb_cache.get(key)
+    if hit is None or hit[0] != catalog.version:
+        plans = [p for p in catalog.plans if trial_ok or not p["plan_flags"].test]
+        hit = _plans_kb_cache[key] = (catalog.version, kb_plans(plans, is_admin, discount_pct))
+    return hit[1]
+
+
 def kb_mysubs(rows):
     kb = [
         [
@@ -109,7 +120,21 @@ def kb_admin_root(is_admin: bool = True, is_support: bool = False):
                 [InlineKeyboardButton(text="Backup", callback_data="admin:backup"), InlineKeyboardButton(text="Restore", callback_data="admin:restore")],
                 [InlineKeyboardButton(text="?? ???? ?????", callback_data="admin:settings")],
                 [InlineKeyboardButton(text="🔌 تست اتصال 3x-ui", callback_data="admin:paneltest")],
+                [InlineKeyboardButton(text="📟 وضعیت سیستم", callback_data="admin:metrics")],
             ]
         )
     rows.append([InlineKeyboardButton(text="⬅️ بازگشت", callback_data="home")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def kb_broadcast_job(job: dict):
+    jid = job["id"]
+    rows = []
+    if job["status"] == "running":
+        rows.append([InlineKeyboardButton(text="⏸ توقف موقت", callback_data=f"admin:bc:pause:{jid}")])
+    elif job["status"] == "paused":
+        rows.append([InlineKeyboardButton(text="▶️ ادامه ارسال", callback_data=f"admin:bc:resume:{jid}")])
+    if job["status"] in ("running", "paused"):
+        rows.append([InlineKeyboardButton(text="✖️ لغو", callback_data=f"admin:bc:cancel:{jid}")])
+    rows.append([InlineKeyboardButton(text="🔄 بروزرسانی", callback_data=f"admin:bc:view:{jid}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
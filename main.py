@@ -6,13 +6,16 @@ from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import ErrorEvent
-from config import BOT_TOKEN
-from db import migrate, ensure_defaults, ensure_default_plans
+from config import BOT_TOKEN, THREEXUI_KEEPALIVE_SEC, EVENT_FLUSH_SEC
+from db import migrate, ensure_defaults, ensure_default_plans, reload_settings
+import adb
+import broadcast
 from handlers import user as user_handlers
 from handlers import payments as payment_handlers
 from handlers import tickets as ticket_handlers
 from handlers import admin as admin_handlers
 from scheduler import scheduler
+from xui import three_session
 from middlewares.force_join import ForceJoinMiddleware
 from middlewares.logging_middleware import LoggingMiddleware
 
@@ -45,7 +48,7 @@ def setup_logging():
 
 async def main():
     logger, events_logger = setup_logging()
-    migrate(); ensure_defaults(); ensure_default_plans()
+    migrate(); reload_settings(); ensure_defaults(); ensure_default_plans()
     bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
     dp.update.middleware(LoggingMiddleware(events_logger))
@@ -63,9 +66,17 @@ async def main():
     dp.include_router(admin_handlers.router)
 
     asyncio.create_task(scheduler(bot))
+    asyncio.create_task(broadcast.resume_all(bot))
+    event_flusher = asyncio.create_task(adb.run_event_sink(EVENT_FLUSH_SEC))
+    if three_session and THREEXUI_KEEPALIVE_SEC > 0:
+        asyncio.create_task(three_session.keepalive(THREEXUI_KEEPALIVE_SEC))
 
     print("PingX bot started (modular).")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        event_flusher.cancel()
+        adb.shutdown()
 
 
 if __name__ == "__main__":
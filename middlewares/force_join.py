@@ -1,49 +1,60 @@
 from typing import Callable, Any, Awaitable
 from aiogram import BaseMiddleware, Bot
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, Update
 from keyboards import kb_force_join
-from db import get_setting
+import adb
 from config import REQUIRED_CHANNEL, REQUIRED_CHANNELS
-from utils import parse_channel_list, fetch_channel_details
+from utils import parse_channel_list, fetch_channel_details, missing_channels, membership_cache
+
+
+def _is_start(text: str | None) -> bool:
+    parts = (text or "").split(maxsplit=1)
+    return bool(parts) and parts[0].split("@", 1)[0] == "/start"
 
 
 class ForceJoinMiddleware(BaseMiddleware):
+    """
+    Blocks private updates from users who are not in every required channel.
+    Staff are never gated, and /start always reaches its handler: it records the user, the
+    referral and the start event (and clears unreachable_at) before running its own join check.
+
+    Membership comes from utils.membership_cache, so ordinary navigation costs no Bot API
+    calls; pressing "recheck_join" drops the user's entries first to force a fresh lookup.
+    """
+
     async def __call__(
         self,
         handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
-        event: Message | CallbackQuery,
+        event: Update | Message | CallbackQuery,
         data: dict[str, Any],
     ) -> Any:
-        chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+        # Registered on dp.update, so unwrap the Update to the message/callback it carries.
+        inner = event
+        if isinstance(event, Update):
+            inner = event.message or event.callback_query
+            if inner is None:
+                return await handler(event, data)
+        chat = getattr(inner, "chat", None) or getattr(getattr(inner, "message", None), "chat", None)
         if not chat or getattr(chat, "type", "private") != "private":
             return await handler(event, data)
 
         uid = None
-        if isinstance(event, Message):
-            uid = event.from_user and event.from_user.id
-        elif isinstance(event, CallbackQuery):
-            uid = event.from_user and event.from_user.id
+        if isinstance(inner, (Message, CallbackQuery)):
+            uid = inner.from_user and inner.from_user.id
         if not uid:
             return await handler(event, data)
+        if isinstance(inner, Message) and _is_start(inner.text):
+            membership_cache.invalidate_user(uid)  # explicit retry, like recheck_join
+            return await handler(event, data)
+        if await adb.is_staff(uid):
+            return await handler(event, data)
 
         bot: Bot = data["bot"]
-        raw = (get_setting("REQUIRED_CHANNELS", "").strip() or get_setting("REQUIRED_CHANNEL", REQUIRED_CHANNEL) or REQUIRED_CHANNEL)
+        raw = ((await adb.get_setting("REQUIRED_CHANNELS", "")).strip() or await adb.get_setting("REQUIRED_CHANNEL", REQUIRED_CHANNEL) or REQUIRED_CHANNEL)
         channels = parse_channel_list(raw)
-        missing = []
-        for ch in channels:
-            chat_id = ch
-            if not ch.startswith("@"):
-                try:
-                    chat_id = int(ch)
-                except Exception:
-                    chat_id = ch
-            try:
-                cm = await bot.get_chat_member(chat_id, uid)
-                status = getattr(cm, "status", None)
-                if status not in ("member", "administrator", "creator"):
-                    missing.append(ch)
-            except Exception:
-                missing.append(ch)
+        if isinstance(inner, CallbackQuery) and inner.data == "recheck_join":
+            membership_cache.invalidate_user(uid)
+        missing = await missing_channels(bot, channels, uid)
         if missing:
             details = await fetch_channel_details(bot, missing)
             lines = "\n".join(f"• {d.get('label')}" for d in details if d.get("label"))
@@ -51,11 +62,11 @@ class ForceJoinMiddleware(BaseMiddleware):
             if lines:
                 text += f"\n{lines}"
             markup = kb_force_join(details)
-            if isinstance(event, Message):
-                await event.answer(text, reply_markup=markup)
+            if isinstance(inner, Message):
+                await inner.answer(text, reply_markup=markup)
             else:
                 try:
-                    await event.message.edit_text(text, reply_markup=markup)
+                    await inner.message.edit_text(text, reply_markup=markup)
                 except Exception:
                     await bot.send_message(uid, text, reply_markup=markup)
             return
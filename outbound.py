@@ -0,0 +1,217 @@
+"""
+Shared, rate-limited sender for messages the bot pushes to chats on its own initiative
+(deliveries, payment decisions, ticket and receipt fan-out, scheduler notices, broadcasts).
+
+Usage:  `await outbound.send(bot.send_message, chat_id, text, priority=outbound.HIGH)`
+
+Every call is queued in one of three priority lanes and released against a global token
+bucket (TG_GLOBAL_RATE msg/s) and a per-chat one (TG_CHAT_RATE msg/s for private chats,
+TG_GROUP_PER_MIN msg/min for groups), so bulk traffic never crowds out purchases or payments.
+TelegramRetryAfter pauses the chat (and the bulk lane) for the requested time and the call is
+retried; other errors are raised to the caller as if the method had been called directly.
+A private chat that turns out blocked or deleted is recorded with adb.mark_unreachable, so
+broadcasts and notices skip it until the user sends /start again.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from config import TG_GLOBAL_RATE, TG_CHAT_RATE, TG_GROUP_PER_MIN
+import adb
+
+logger = logging.getLogger("pingx.outbound")
+
+HIGH, NORMAL, BULK = 0, 1, 2
+LANE_NAMES = ("high", "normal", "bulk")
+MAX_RETRIES = 3
+LOOKAHEAD = 64  # jobs inspected per lane when the head's chat is still rate-limited
+MAX_INFLIGHT = 64
+
+
+def is_unreachable(e: Exception) -> bool:
+    """Errors that mean the chat will keep refusing messages (bot blocked, account deleted)."""
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    return isinstance(e, TelegramBadRequest) and "chat not found" in str(e).lower()
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ("priority", "chat_id", "method", "args", "kwargs", "future", "attempts")
+
+    def __init__(self, priority, chat_id, method, args, kwargs, future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class Dispatcher:
+    def __init__(self, global_rate: float, chat_rate: float, group_per_min: float):
+        self.global_rate = max(0.1, global_rate)
+        self.chat_rate = max(0.01, chat_rate)
+        self.group_rate = max(0.01, group_per_min / 60)
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._chats: dict[int, TokenBucket] = {}
+        self._blocked: dict[int, float] = {}  # chat_id -> monotonic time a RetryAfter ends
+        self._bulk_paused_until = 0.0
+        self._lanes = [deque(), deque(), deque()]
+        self._wake = asyncio.Event()
+        self._inflight = asyncio.Semaphore(MAX_INFLIGHT)
+        self._task: asyncio.Task | None = None
+        self._calls: set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.unreachable = 0
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "unreachable": self.unreachable,
+            **{f"queued_{name}": len(lane) for name, lane in zip(LANE_NAMES, self._lanes)},
+        }
+
+    def submit(self, method, chat_id, *args, priority: int = NORMAL, **kwargs) -> asyncio.Future:
+        """Queue `method(chat_id, *args, **kwargs)`; the returned future resolves to its result."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._lanes[priority].append(_Job(priority, chat_id, method, args, kwargs, future))
+        self._wake.set()
+        return future
+
+    async def send(self, method, chat_id, *args, priority: int = NORMAL, **kwargs):
+        return await self.submit(method, chat_id, *args, priority=priority, **kwargs)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10_000:
+                now = time.monotonic()
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle(now)}
+            rate = self.group_rate if str(chat_id)[:1] in ("-", "@") else self.chat_rate
+            b = self._chats[chat_id] = TokenBucket(rate, max(1.0, min(3.0, rate * 3)))
+        return b
+
+    def _chat_wait(self, chat_id: int, now: float) -> float:
+        blocked = self._blocked.get(chat_id, 0.0) - now
+        if blocked > 0:
+            return blocked
+        self._blocked.pop(chat_id, None)
+        return self._chat_bucket(chat_id).wait_time(now)
+
+    def _next_job(self, now: float) -> tuple["_Job | None", float]:
+        """Highest-priority job whose chat may send now, else the shortest wait seen."""
+        wait = 1.0
+        for priority, lane in enumerate(self._lanes):
+            if priority == BULK and self._bulk_paused_until > now:
+                wait = min(wait, self._bulk_paused_until - now)
+                continue
+            for i, job in enumerate(itertools.islice(lane, LOOKAHEAD)):
+                w = self._chat_wait(job.chat_id, now)
+                if w <= 0:
+                    del lane[i]
+                    return job, 0.0
+                wait = min(wait, w)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            if not any(self._lanes):
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            now = time.monotonic()
+            gwait = self._global.wait_time(now)
+            if gwait > 0:
+                await asyncio.sleep(gwait)
+                continue
+            job, wait = self._next_job(now)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._global.take(now)
+            self._chat_bucket(job.chat_id).take(now)
+            await self._inflight.acquire()
+            task = asyncio.create_task(self._call(job))
+            self._calls.add(task)
+            task.add_done_callback(self._calls.discard)
+
+    async def _call(self, job: _Job):
+        try:
+            if job.future.cancelled():
+                return
+            result = await job.method(job.chat_id, *job.args, **job.kwargs)
+        except TelegramRetryAfter as e:
+            until = time.monotonic() + float(e.retry_after)
+            self._blocked[job.chat_id] = until
+            self._bulk_paused_until = max(self._bulk_paused_until, until)
+            job.attempts += 1
+            if job.attempts <= MAX_RETRIES:
+                self.retried += 1
+                logger.warning("flood wait %ss chat=%s lane=%s", e.retry_after, job.chat_id, LANE_NAMES[job.priority])
+                self._lanes[job.priority].appendleft(job)
+                self._wake.set()
+            else:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if is_unreachable(e) and isinstance(job.chat_id, int) and job.chat_id > 0:
+                self.unreachable += 1
+                try:
+                    await adb.mark_unreachable(job.chat_id)
+                except Exception:
+                    logger.warning("could not mark chat %s unreachable", job.chat_id, exc_info=True)
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._inflight.release()
+
+
+dispatcher = Dispatcher(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_GROUP_PER_MIN)
+send = dispatcher.send
+submit = dispatcher.submit
@@ -1,88 +1,258 @@
 import asyncio
+import heapq
 import logging
-import math
+import random
+import time
 from datetime import datetime
 from aiogram import Bot
-from db import cur, cache_set_usage, list_active_purchases
-from utils import TZ
+from config import (
+    SYNC_WORKERS,
+    SYNC_DEADLINE_SEC,
+    SYNC_TICK_SEC,
+    SYNC_INTERVAL_SEC,
+    SYNC_MIN_INTERVAL_SEC,
+    SYNC_MAX_INTERVAL_SEC,
+    SYNC_SHARDS,
+    SYNC_JITTER,
+)
+import adb
+import outbound
+from db import alert_levels, DAY_MS
+from utils import TZ, now_iso
 from xui import three_session
 
 logger = logging.getLogger("pingx.scheduler")
 
+# Last finished usage sync batch, plus live counters while one is running (see admin metrics).
+sync_metrics: dict = {}
+sync_progress: dict = {}
 
-async def _sync_usage_cache():
-    if not three_session:
-        return
+
+class SyncQueue:
+    """
+    Min-heap of (due_ms, purchase_id): when each active purchase should next be read from the panel.
+    Rescheduling pushes a new entry; the superseded one is skipped when it surfaces.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[int, int]] = []
+        self._due: dict[int, int] = {}
+        self.max_id = 0
+
+    def __len__(self):
+        return len(self._due)
+
+    def push(self, pid: int, due_ms: int):
+        self._due[pid] = due_ms
+        heapq.heappush(self._heap, (due_ms, pid))
+        self.max_id = max(self.max_id, pid)
+
+    def pop_due(self, now_ms: int) -> list[int]:
+        out = []
+        while self._heap and self._heap[0][0] <= now_ms:
+            due_ms, pid = heapq.heappop(self._heap)
+            if self._due.get(pid) == due_ms:
+                del self._due[pid]
+                out.append(pid)
+        return out
+
+    def next_due_ms(self) -> int | None:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+
+def first_sync_due_ms(pid: int, now_ms: int) -> int:
+    """
+    Where a purchase enters the queue: shard pid % SYNC_SHARDS owns one slice of SYNC_INTERVAL_SEC,
+    at a random point inside it, so a restart or a bulk of new purchases reaches the panel as an even
+    trickle across the interval rather than as one burst.
+    """
+    shards = max(1, SYNC_SHARDS)
+    slice_ms = SYNC_INTERVAL_SEC * 1000 / shards
+    return now_ms + int(((pid % shards) + random.random()) * slice_ms)
+
+
+def _jittered(delay_sec: float) -> float:
+    # Purchases synced in the same batch with the same delay would otherwise stay in lockstep.
+    return delay_sec * (1 + random.uniform(-SYNC_JITTER, SYNC_JITTER))
+
+
+def next_sync_delay_sec(r: dict, used: int, total: int, expiry_ms: int, now_ms: int) -> float:
+    """
+    Seconds until this purchase should be synced again: half the estimated time to its next
+    usage threshold (from the consumption rate since the previous sync) or expiry threshold,
+    clamped to [SYNC_MIN_INTERVAL_SEC, SYNC_MAX_INTERVAL_SEC]. Idle purchases sit at the max.
+    """
+    usage_pcts, expiry_days = alert_levels()
+    delays = []
+    prev_used, prev_ms = r.get("prev_used"), r.get("prev_ms")
+    if prev_used is None or not prev_ms or prev_ms >= now_ms or (r.get("prev_total") or 0) != total:
+        delays.append(SYNC_INTERVAL_SEC)  # no comparable previous sample: default cadence
+    elif total > 0 and used > prev_used:
+        rate = (used - prev_used) / (now_ms - prev_ms)  # bytes/ms since the usage last changed
+        pending = [t * total / 100 for t in usage_pcts if t * total / 100 > used]
+        if pending:
+            delays.append((min(pending) - used) / rate / 2000)
+    if expiry_ms and expiry_ms > now_ms:
+        pending = [expiry_ms - d * DAY_MS - now_ms for d in expiry_days if expiry_ms - d * DAY_MS > now_ms]
+        if pending:
+            delays.append(min(pending) / 2000)
+    delay = min(delays) if delays else SYNC_MAX_INTERVAL_SEC
+    return max(SYNC_MIN_INTERVAL_SEC, min(SYNC_MAX_INTERVAL_SEC, delay))
+
+
+async def _sync_one(r: dict, snapshots: dict, sem: asyncio.Semaphore, progress: dict, results: list):
+    try:
+        inbound_id = int(r["three_xui_inbound_id"])
+        client_id = r["three_xui_client_id"]
+        snap = snapshots.get(inbound_id)
+        if snap is None:
+            progress["failed"] += 1  # inbound not fetched this round; retried with the batch leftovers
+            return
+        if snap.has_traffic:
+            stat = snap.find(client_id=client_id, email=r.get("client_email"), sub_id=r.get("sub_id"))
+        else:
+            # Inbound payload without clientStats: only the traffic endpoint knows up/down.
+            async with sem:
+                stat = await three_session.get_client_stats(inbound_id, client_id, r.get("client_email"))
+        if not stat:
+            progress["missing"] += 1
+            return
+        total = int(stat.get("total") or 0)
+        if total <= 0 and int(r.get("allocated_gb") or 0) > 0:
+            total = int(r["allocated_gb"]) * 1024**3
+        expiry = int(stat.get("expiryTime") or r.get("expiry_ms") or 0)
+        results.append((r["id"], int(stat.get("up") or 0), int(stat.get("down") or 0), total, expiry))
+        progress["done"] += 1
+    except Exception:
+        progress["failed"] += 1
+        logger.exception("usage sync failed pid=%s", r.get("id"))
+
+
+async def _sync_batch(queue: SyncQueue, due: list[int], rescheduled: set[int]):
+    """
+    Sync panel usage for the purchases that are due, then schedule each one's next sync.
+    Each inbound involved is fetched once per batch (usually a single list request) and every
+    purchase is a lookup in that snapshot, however small the batch. The batch is cut off at
+    SYNC_DEADLINE_SEC; purchases that got no reading are retried after SYNC_INTERVAL_SEC.
+    """
+    started = time.monotonic()
+    deadline = started + max(1, SYNC_DEADLINE_SEC)
     now_ms = int(datetime.now(TZ).timestamp() * 1000)
-    active = list_active_purchases(now_ms=now_ms)
-    for r in active:
+    active = await adb.purchases_for_sync(due, now_ms)
+    progress = {"started_at": now_iso(), "total": len(active), "done": 0, "missing": 0, "failed": 0, "timed_out": 0, "written": 0}
+    sync_progress.clear()
+    sync_progress.update(progress)
+    snapshots = {}
+    if active:
         try:
-            inbound_id = int(r["three_xui_inbound_id"])
-            client_id = r["three_xui_client_id"]
-            stat = await three_session.get_client_stats(inbound_id, client_id, r.get("client_email"))
-            if not stat:
-                continue
-            total = int(stat.get("total") or 0)
-            if total <= 0 and int(r.get("allocated_gb") or 0) > 0:
-                total = int(r["allocated_gb"]) * 1024**3
-            expiry = int(stat.get("expiryTime") or r.get("expiry_ms") or 0)
-            cache_set_usage(r["id"], int(stat.get("up") or 0), int(stat.get("down") or 0), total, expiry)
-        except Exception:
-            logger.exception("usage sync failed pid=%s", r.get("id"))
+            snapshots = await asyncio.wait_for(
+                three_session.snapshot_inbounds({r.get("three_xui_inbound_id") for r in active}),
+                timeout=max(1.0, deadline - time.monotonic()),
+            )
+        except asyncio.TimeoutError:
+            logger.warning("usage sync: inbound snapshot timed out, batch retried later")
+    sem = asyncio.Semaphore(max(1, SYNC_WORKERS))
+    results: list[tuple] = []
+    tasks = [asyncio.create_task(_sync_one(r, snapshots, sem, sync_progress, results)) for r in active]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+        for t in pending:
+            t.cancel()
+        sync_progress["timed_out"] = len(pending)
+    # One transaction per batch instead of one autocommit per purchase; unchanged rows are skipped.
+    if results:
+        sync_progress["written"] = await adb.cache_set_usage_many(results)
+    # Purchases no longer active/unexpired were not returned and simply leave the queue.
+    done_ms = int(datetime.now(TZ).timestamp() * 1000)
+    synced = {pid: (up + down, total, expiry) for pid, up, down, total, expiry in results}
+    for r in active:
+        got = synced.get(r["id"])
+        delay = next_sync_delay_sec(r, *got, now_ms) if got else SYNC_INTERVAL_SEC
+        queue.push(r["id"], done_ms + int(_jittered(delay) * 1000))
+        rescheduled.add(r["id"])
+    sync_progress["queued"] = len(queue)
+    sync_progress["duration"] = round(time.monotonic() - started, 2)
+    sync_metrics.clear()
+    sync_metrics.update(sync_progress)
+    logger.info(
+        "usage sync done total=%s done=%s written=%s missing=%s failed=%s timed_out=%s duration=%ss",
+        sync_metrics["total"],
+        sync_metrics["done"],
+        sync_metrics["written"],
+        sync_metrics["missing"],
+        sync_metrics["failed"],
+        sync_metrics["timed_out"],
+        sync_metrics["duration"],
+    )
+
+
+async def _sync_usage_cache(queue: SyncQueue, due: list[int]):
+    """
+    Run one batch of popped ids. If it fails part-way, every id it did not reschedule goes back
+    in the queue after SYNC_MIN_INTERVAL_SEC; otherwise they would be lost until a restart, since
+    new ids are only picked up above queue.max_id.
+    """
+    rescheduled: set[int] = set()
+    try:
+        await _sync_batch(queue, due, rescheduled)
+    except BaseException:
+        retry_ms = int(datetime.now(TZ).timestamp() * 1000) + SYNC_MIN_INTERVAL_SEC * 1000
+        for pid in due:
+            if pid not in rescheduled:
+                queue.push(pid, retry_ms)
+        raise
+
+
+def _notice_text(kind: str, level: int) -> str:
+    if kind == "usage":
+        if level >= 100:
+            return "⛔️ حجم اشتراک شما به پایان رسید."
+        return f"⚠️ مصرف شما به {level}٪ رسیده است."
+    if level <= 0:
+        return "⌛️ اشتراک شما منقضی شد."
+    return f"⏳ اشتراک شما {level} روز دیگر منقضی می‌شود."
+
+
+async def _send_notices(bot: Bot):
+    """One query for everything that is due, sends, then one batched write of what was sent."""
+    now_ms = int(datetime.now(TZ).timestamp() * 1000)
+    usage_sent: list[tuple[int, int]] = []
+    expiry_sent: list[tuple[int, int]] = []
+    try:
+        for r in await adb.due_notices(now_ms):
+            uid, pid, level = r["user_id"], r["purchase_id"], r["level"]
+            try:
+                await outbound.send(bot.send_message, uid, _notice_text(r["kind"], level))
+                (usage_sent if r["kind"] == "usage" else expiry_sent).append((pid, level))
+            except Exception:
+                logger.warning("send %s warn failed pid=%s uid=%s", r["kind"], pid, uid, exc_info=True)
+    finally:
+        # Whatever went out is recorded even if the pass is interrupted.
+        await adb.mark_notices_sent(usage_sent, expiry_sent)
 
 
 async def scheduler(bot: Bot):
+    """
+    Every SYNC_TICK_SEC: enqueue new purchases, sync the ones whose due time has come, and send
+    any notices that became due. Busy purchases come round every few minutes, idle ones hours apart.
+    """
     await asyncio.sleep(5)
+    queue = SyncQueue()
     while True:
+        if three_session:
+            try:
+                now_ms = int(datetime.now(TZ).timestamp() * 1000)
+                for pid in await adb.active_purchase_ids(now_ms, queue.max_id):
+                    queue.push(pid, first_sync_due_ms(pid, now_ms))
+                due = queue.pop_due(now_ms)
+                if due:
+                    await _sync_usage_cache(queue, due)
+            except Exception:
+                logger.exception("scheduler usage sync error")
         try:
-            await _sync_usage_cache()
-        except Exception:
-            logger.exception("scheduler usage sync error")
-        try:
-            rows = [dict(r) for r in cur.execute("SELECT * FROM purchases WHERE active=1").fetchall()]
-            now_ms = int(datetime.now(TZ).timestamp() * 1000)
-            for r in rows:
-                uid = r["user_id"]
-                pid = r["id"]
-
-                cached = cur.execute("SELECT * FROM cache_usage WHERE purchase_id=?", (pid,)).fetchone()
-                if cached:
-                    used = int(cached["up"] or 0) + int(cached["down"] or 0)
-                    total = int(cached["total"] or 0)
-                    if total > 0:
-                        pct = used / total
-                        last_usage_warn = (cached["last_usage_warn"] or "").strip() if "last_usage_warn" in cached.keys() else ""
-                        if 0.80 <= pct < 0.83 and last_usage_warn != "80":
-                            try:
-                                await bot.send_message(uid, f"⚠️ مصرف شما به {int(pct*100)}٪ نزدیک شده است.")
-                                cur.execute("UPDATE cache_usage SET last_usage_warn=? WHERE purchase_id=?", ("80", pid))
-                            except Exception:
-                                logger.warning("send usage warn failed pid=%s uid=%s", pid, uid, exc_info=True)
-
-                expiry_ms = int(r["expiry_ms"] or 0)
-                if expiry_ms > 0:
-                    days_left = math.ceil((expiry_ms - now_ms) / 1000 / 3600 / 24)
-                    try:
-                        last_exp_notice = int(r.get("last_expiry_notice"))
-                    except Exception:
-                        last_exp_notice = None
-                    last_at = r.get("last_expiry_notice_at")
-                    recent = False
-                    if last_at:
-                        try:
-                            last_dt = datetime.fromisoformat(last_at)
-                            recent = (datetime.now(TZ) - last_dt).total_seconds() < 86_400
-                        except Exception:
-                            recent = False
-                    if days_left > 0 and days_left in (3, 1) and last_exp_notice != days_left and not recent:
-                        try:
-                            await bot.send_message(uid, f"⏳ اشتراک شما {days_left} روز دیگر منقضی می‌شود.")
-                            cur.execute(
-                                "UPDATE purchases SET last_expiry_notice=?, last_expiry_notice_at=? WHERE id=?",
-                                (days_left, datetime.now(TZ).isoformat(), pid),
-                            )
-                        except Exception:
-                            logger.warning("send expiry warn failed pid=%s uid=%s", pid, uid, exc_info=True)
+            await _send_notices(bot)
         except Exception:
             logger.exception("scheduler loop error")
-        await asyncio.sleep(1800)
+        await asyncio.sleep(max(1, SYNC_TICK_SEC))
@@ -0,0 +1,15 @@
+"""
+Shared setup: config and db read the environment at import time, so point them at a throwaway
+database before any test module imports them.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+_tmp = tempfile.mkdtemp(prefix="pingx-tests-")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:test")
+os.environ["DB_PATH"] = os.path.join(_tmp, "bot.db")
@@ -0,0 +1,71 @@
+"""Keyset pages: every row shows up exactly once, including rows written without an epoch-ms key."""
+import time
+import pytest
+import db
+
+NOW_MS = int(time.time() * 1000)
+
+
+@pytest.fixture
+def tickets():
+    db.migrate()
+    db.cur.execute("DELETE FROM tickets")
+    ids = []
+    for i in range(5):
+        ts = f"2026-01-0{i + 1}T00:00:00+00:00"
+        db.cur.execute(
+            "INSERT INTO tickets(user_id,status,opened_at,last_activity,last_activity_ms) VALUES(?, 'closed', ?, ?, ?)",
+            (100 + i, ts, ts, NOW_MS - (5 - i) * 1000),
+        )
+        ids.append(db.cur.lastrowid)
+    # Legacy row: no ms twin and text that does not parse as a date.
+    db.cur.execute(
+        "INSERT INTO tickets(user_id,status,opened_at,last_activity) VALUES(200, 'closed', 'n/a', 'n/a')"
+    )
+    ids.append(db.cur.lastrowid)
+    yield ids
+    db.cur.execute("DELETE FROM tickets")
+
+
+def _walk(size: int, backward: bool = False) -> list[int]:
+    seen: list[int] = []
+    rows, has_prev, has_next = db.list_tickets_page(size)
+    if backward:
+        while has_next:
+            rows, has_prev, has_next = db.list_tickets_page(size, after_id=rows[-1]["id"])
+        seen = [r["id"] for r in rows]
+        while has_prev:
+            rows, has_prev, _ = db.list_tickets_page(size, before_id=rows[0]["id"])
+            seen = [r["id"] for r in rows] + seen
+        return seen
+    seen += [r["id"] for r in rows]
+    while has_next:
+        rows, has_prev, has_next = db.list_tickets_page(size, after_id=rows[-1]["id"])
+        seen += [r["id"] for r in rows]
+    return seen
+
+
+def test_insert_without_ms_gets_a_key(tickets):
+    legacy = tickets[-1]
+    row = db.cur.execute("SELECT last_activity_ms FROM tickets WHERE id=?", (legacy,)).fetchone()
+    assert row["last_activity_ms"] == 0
+
+
+@pytest.mark.parametrize("backward", [False, True])
+def test_tickets_pages_keep_legacy_row_across_boundary(tickets, backward):
+    # Page size 4 puts the boundary right before the legacy (oldest) row.
+    seen = _walk(4, backward)
+    assert sorted(seen) == sorted(tickets)
+    assert len(seen) == len(set(seen))
+    assert seen[-1] == tickets[-1]
+
+
+def test_backfill_fills_unparseable_text_with_zero(tickets):
+    db.cur.execute(
+        "INSERT OR REPLACE INTO users(user_id,created_at,created_at_ms) VALUES(900,'not a date',NULL)"
+    )
+    db.cur.execute("UPDATE users SET created_at_ms=NULL WHERE user_id=900")
+    db._backfill_epoch_ms("users", "created_at")
+    row = db.cur.execute("SELECT created_at_ms FROM users WHERE user_id=900").fetchone()
+    assert row["created_at_ms"] == 0
+    db.cur.execute("DELETE FROM users WHERE user_id=900")
@@ -0,0 +1,81 @@
+"""
+EXPLAIN QUERY PLAN guards for the hot queries: none of them may fall back to a full table scan.
+The SQL is captured from the real db functions (users keyset page mirrors
+handlers/admin.py `_users_keyset_page`), so a schema or query change that loses its index fails here.
+"""
+import re
+import time
+import pytest
+import db
+
+NOW_MS = int(time.time() * 1000)
+FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)\S+( AS \S+)?$")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def schema():
+    db.migrate()
+    db.reload_settings()
+    db.ensure_defaults()
+    tid = db.get_or_open_ticket(1)
+    db.cur.execute(
+        "INSERT OR IGNORE INTO users(user_id,created_at,created_at_ms) VALUES(1,'2026-01-01T00:00:00+00:00',?)", (NOW_MS,)
+    )
+    return tid
+
+
+def _captured(fn, *args, **kwargs) -> list[str]:
+    """Statements `fn` sends to this thread's connection (parameters already inlined)."""
+    seen: list[str] = []
+    conn = db.cur.connection
+    conn.set_trace_callback(seen.append)
+    try:
+        fn(*args, **kwargs)
+    finally:
+        conn.set_trace_callback(None)
+    return [s for s in seen if s.lstrip().upper().startswith(("SELECT", "WITH"))]
+
+
+def _full_scans(sql: str, params=()) -> list[str]:
+    plan = db.cur.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [r["detail"] for r in plan if FULL_SCAN.match(r["detail"])]
+
+
+HOT_QUERIES = {
+    "due_notices": lambda: db.due_notices(NOW_MS),
+    "get_active_purchase_for_inbound": lambda: db.get_active_purchase_for_inbound(1, 1, NOW_MS),
+    "list_active_purchases": lambda: db.list_active_purchases(NOW_MS),
+    "list_active_purchases_inbound": lambda: db.list_active_purchases(NOW_MS, 1),
+    "active_purchase_ids": lambda: db.active_purchase_ids(NOW_MS, 0),
+    "pending_payments_first": lambda: db.db_list_pending_payments_page(10),
+    "pending_payments_after": lambda: db.db_list_pending_payments_page(10, after_id=100),
+    "pending_payments_before": lambda: db.db_list_pending_payments_page(10, before_id=100),
+    "tickets_first": lambda: db.list_tickets_page(10),
+    "tickets_after": lambda: db.list_tickets_page(10, after_id=1),
+    "find_ticket_by_msg_id": lambda: db.find_ticket_by_msg_id(42),
+    "events_count": lambda: db.events_count("start", "2026-01-01T00:00:00+00:00", "2026-02-01T00:00:00+00:00"),
+    "purchases_stats_range": lambda: db.purchases_stats_range("2026-01-01T00:00:00+00:00", "2026-02-01T00:00:00+00:00"),
+    "user_ids_after": lambda: db.user_ids_after(0, 200),
+}
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_index(name):
+    statements = _captured(HOT_QUERIES[name])
+    assert statements, f"{name} ran no SELECT"
+    for sql in statements:
+        assert _full_scans(sql) == [], sql
+
+
+@pytest.mark.parametrize("direction", ["first", "after", "before"])
+def test_users_keyset_page_uses_index(direction):
+    q = "SELECT user_id,username,first_name,last_name,wallet,created_at FROM users"
+    params: list = []
+    order = "ASC" if direction == "before" else "DESC"
+    if direction != "first":
+        op = ">" if direction == "before" else "<"
+        q += f" WHERE (created_at_ms, user_id) {op} (SELECT created_at_ms, user_id FROM users WHERE user_id=?)"
+        params.append(1)
+    q += f" ORDER BY created_at_ms {order}, user_id {order} LIMIT ?"
+    params.append(11)
+    assert _full_scans(q, params) == []
@@ -0,0 +1,95 @@
+"""Usage sync queue: popped purchases must never fall out of the queue when a batch fails."""
+import asyncio
+import time
+import pytest
+import scheduler
+from scheduler import SyncQueue
+
+NOW_MS = int(time.time() * 1000)
+
+
+def _rows(ids):
+    return [
+        {"id": pid, "three_xui_inbound_id": "1", "three_xui_client_id": f"c{pid}", "client_email": f"u{pid}@x",
+         "allocated_gb": 10, "expiry_ms": 0, "prev_used": None, "prev_total": None, "prev_ms": None}
+        for pid in ids
+    ]
+
+
+class _FailingPanel:
+    async def snapshot_inbounds(self, inbound_ids):
+        raise RuntimeError("panel down")
+
+
+class _Snapshot:
+    has_traffic = True
+
+    def find(self, client_id=None, email=None, sub_id=None):
+        return {"up": 111, "down": 222, "total": 10 * 1024**3, "expiryTime": 0}
+
+
+class _Panel:
+    async def snapshot_inbounds(self, inbound_ids):
+        return {1: _Snapshot()}
+
+
+@pytest.fixture
+def due_queue(monkeypatch):
+    ids = list(range(1, 3001))
+    queue = SyncQueue()
+    for pid in ids:
+        queue.push(pid, NOW_MS - 1)
+    due = queue.pop_due(NOW_MS)
+    assert len(due) == len(ids) and len(queue) == 0
+
+    async def purchases_for_sync(pids, now_ms):
+        return _rows(pids)
+
+    monkeypatch.setattr(scheduler.adb, "purchases_for_sync", purchases_for_sync)
+    return queue, due
+
+
+def test_failed_batch_requeues_popped_ids(monkeypatch, due_queue):
+    queue, due = due_queue
+    monkeypatch.setattr(scheduler, "three_session", _FailingPanel())
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scheduler._sync_usage_cache(queue, due))
+
+    assert len(queue) == len(due)
+    assert queue.next_due_ms() >= NOW_MS + scheduler.SYNC_MIN_INTERVAL_SEC * 1000
+    assert queue.pop_due(NOW_MS) == []
+
+
+def test_failed_write_requeues_popped_ids(monkeypatch, due_queue):
+    queue, due = due_queue
+    monkeypatch.setattr(scheduler, "three_session", _Panel())
+
+    async def cache_set_usage_many(rows):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(scheduler.adb, "cache_set_usage_many", cache_set_usage_many)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scheduler._sync_usage_cache(queue, due))
+
+    assert len(queue) == len(due)
+
+
+def test_batch_reschedules_from_snapshot(monkeypatch, due_queue):
+    queue, due = due_queue
+    monkeypatch.setattr(scheduler, "three_session", _Panel())
+    written = []
+
+    async def cache_set_usage_many(rows):
+        written.extend(rows)
+        return len(rows)
+
+    monkeypatch.setattr(scheduler.adb, "cache_set_usage_many", cache_set_usage_many)
+
+    asyncio.run(scheduler._sync_usage_cache(queue, due))
+
+    assert len(written) == len(due)
+    assert {(up, down) for _pid, up, down, _total, _exp in written} == {(111, 222)}
+    assert len(queue) == len(due)
+    assert queue.next_due_ms() > NOW_MS
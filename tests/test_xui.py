@@ -0,0 +1,50 @@
+"""3x-ui client lookups: renewal must keep the settings client's UUID and subId."""
+import asyncio
+import json
+import pytest
+import db
+from xui import ThreeXUISession
+
+UUID = "8c1f0f0e-3b1a-4c55-9a57-0f6a3b7d2e11"
+SUB_ID = "k3j4h5g6f7d8s9a0"
+EMAIL = "u42@x"
+
+
+@pytest.fixture(scope="module", autouse=True)
+def migrated():
+    db.migrate()
+
+
+class _StockPanel(ThreeXUISession):
+    """`inbounds/get` without `clientStats`, as stock panels answer; traffic comes from its own endpoint."""
+
+    def __init__(self):
+        super().__init__("http://panel.local", "admin", "admin")
+        self.calls = []
+
+    async def request(self, method, path, **kw):
+        self.calls.append(path)
+        if path.startswith("/panel/api/inbounds/get/"):
+            settings = {"clients": [{"id": UUID, "email": EMAIL, "subId": SUB_ID, "flow": "",
+                                     "limitIp": 0, "enable": True, "totalGB": 0, "expiryTime": 0}]}
+            return {"success": True, "obj": {"id": 1, "settings": json.dumps(settings)}}
+        if "getClientTraffics/" in path:
+            return {"success": True, "obj": {"id": 17, "inboundId": 1, "email": EMAIL, "up": 100,
+                                             "down": 200, "total": 5 * 1024**3, "expiryTime": 0}}
+        raise AssertionError(f"unexpected request {path}")
+
+
+def test_client_stats_keep_settings_client_without_client_stats():
+    panel = _StockPanel()
+    stat = asyncio.run(panel.get_client_stats(1, UUID, EMAIL))
+
+    assert any("getClientTraffics/" in p for p in panel.calls)
+    assert stat["up"] == 100 and stat["down"] == 200
+    assert stat["total"] == 5 * 1024**3
+
+    # Same payload the renewal handler builds and hands to update_client.
+    payload = dict(stat)
+    payload["total"] = stat["total"] + 10 * 1024**3
+    assert (payload.get("id") or UUID) == UUID
+    assert payload["subId"] == SUB_ID
+    assert payload["flow"] == "" and payload["enable"] is True
@@ -1,8 +1,9 @@
-import html, math, secrets, re
+import html, math, secrets, re, time
 from typing import Any
 from datetime import datetime, timezone
 from io import BytesIO
 import qrcode
+from config import FORCE_JOIN_MEMBER_TTL_SEC, FORCE_JOIN_NONMEMBER_TTL_SEC, CHANNEL_DETAILS_TTL_SEC
 
 TZ = timezone.utc
 
@@ -17,6 +18,17 @@ def progress_bar(p:float,w:int=20)->str:
 
 def now_iso(): return datetime.now(TZ).isoformat()
 
+def now_ms()->int: return round(datetime.now(TZ).timestamp()*1000)
+
+def now_iso_ms()->tuple[str,int]:
+    """The same instant as (ISO text, epoch ms), for rows that store both."""
+    d=datetime.now(TZ); return d.isoformat(), round(d.timestamp()*1000)
+
+def iso_to_ms(s:str)->int:
+    d=datetime.fromisoformat(s)
+    if d.tzinfo is None: d=d.replace(tzinfo=TZ)
+    return round(d.timestamp()*1000)
+
 def format_toman(amount:int|float)->str:
     try:
         amt = int(round(float(amount)))
@@ -64,6 +76,20 @@ def normalize_channel_handle(ch: str) -> str:
     return "@" + ch
 
 
+# Keyset page tokens used in callback_data: "0" = first page, "a<id>" = after id, "b<id>" = before id.
+PAGE_TOKEN_RE = r"(?:\d+|[ab]\d+)"
+
+
+def parse_page_token(token: str) -> tuple[int | None, int | None]:
+    """Return (after_id, before_id) for a page token; plain numbers (legacy page indexes) mean the first page."""
+    token = (token or "").strip()
+    if token[:1] == "a" and token[1:].isdigit():
+        return int(token[1:]), None
+    if token[:1] == "b" and token[1:].isdigit():
+        return None, int(token[1:])
+    return None, None
+
+
 def parse_channel_list(value: str) -> list[str]:
     if not value:
         return []
@@ -76,19 +102,114 @@ def parse_channel_list(value: str) -> list[str]:
     return seen
 
 
+def channel_chat_id(ch: str) -> Any:
+    """Bot API chat id for a normalized channel handle: "@name" stays, "-100..." becomes int."""
+    if ch.startswith("@"):
+        return ch
+    try:
+        return int(ch)
+    except Exception:
+        return ch
+
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+class MembershipCache:
+    """
+    Channel membership per (channel, user) with separate TTLs for members and non-members.
+
+    Members are kept long (leaving is rare and arrives as a chat_member update when the bot
+    administers the channel); non-members briefly, so joining without pressing "recheck" still
+    unlocks the bot quickly. Entries are grouped per user so one update drops all of them.
+    """
+
+    def __init__(self, member_ttl: float, nonmember_ttl: float, max_users: int = 50_000):
+        self.member_ttl = member_ttl
+        self.nonmember_ttl = nonmember_ttl
+        self.max_users = max_users
+        self._users: dict[int, dict[str, tuple[float, bool]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, ch: str, uid: int) -> bool | None:
+        entry = self._users.get(uid, {}).get(ch)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, ch: str, uid: int, is_member: bool):
+        entries = self._users.get(uid)
+        if entries is None:
+            if len(self._users) >= self.max_users:
+                self._users.pop(next(iter(self._users)))
+            entries = self._users[uid] = {}
+        ttl = self.member_ttl if is_member else self.nonmember_ttl
+        entries[ch] = (time.monotonic() + ttl, is_member)
+
+    def invalidate_user(self, uid: int):
+        if self._users.pop(uid, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._users.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "users": len(self._users),
+        }
+
+
+membership_cache = MembershipCache(FORCE_JOIN_MEMBER_TTL_SEC, FORCE_JOIN_NONMEMBER_TTL_SEC)
+
+
+async def is_channel_member(bot: Any, ch: str, uid: int) -> bool:
+    """get_chat_member through membership_cache; a failed lookup counts as not a member."""
+    cached = membership_cache.get(ch, uid)
+    if cached is not None:
+        return cached
+    try:
+        cm = await bot.get_chat_member(channel_chat_id(ch), uid)
+        is_member = getattr(cm, "status", None) in MEMBER_STATUSES
+    except Exception:
+        is_member = False
+    membership_cache.put(ch, uid, is_member)
+    return is_member
+
+
+async def missing_channels(bot: Any, channels: list[str], uid: int) -> list[str]:
+    return [ch for ch in channels if not await is_channel_member(bot, ch, uid)]
+
+
+# Channel title/link shown on the force-join prompt; the same for every user.
+_channel_details: dict[str, tuple[float, dict]] = {}
+channel_details_stats = {"hits": 0, "misses": 0}
+
+
 async def fetch_channel_details(bot: Any, channels: list[str]):
     details = []
+    now = time.monotonic()
     for ch in channels:
         if not ch:
             continue
-        chat_id: Any = ch
-        if not ch.startswith("@"):
-            try:
-                chat_id = int(ch)
-            except Exception:
-                chat_id = ch
+        cached = _channel_details.get(ch)
+        if cached and cached[0] > now:
+            channel_details_stats["hits"] += 1
+            details.append(cached[1])
+            continue
+        channel_details_stats["misses"] += 1
+        chat_id = channel_chat_id(ch)
         label = ch.lstrip("@") if ch.startswith("@") else ch
         url = None
+        ttl = CHANNEL_DETAILS_TTL_SEC
         try:
             chat = await bot.get_chat(chat_id)
             label = chat.title or chat.username or label
@@ -99,7 +220,10 @@ async def fetch_channel_details(bot: Any, channels: list[str]):
             elif invite:
                 url = invite
         except Exception:
+            ttl = FORCE_JOIN_NONMEMBER_TTL_SEC  # retry soon, e.g. once the bot is added to the channel
             if ch.startswith("@"):
                 url = f"https://t.me/{ch.lstrip('@')}"
-        details.append({"id": ch, "label": label, "url": url})
+        detail = {"id": ch, "label": label, "url": url}
+        _channel_details[ch] = (now + ttl, detail)
+        details.append(detail)
     return details
@@ -1,19 +1,111 @@
+import asyncio
+import contextvars
+import functools
 import json
 import secrets
+import time
+from collections import Counter
 from uuid import uuid4
 from datetime import datetime, timedelta, timezone
 import logging
 import httpx
 from config import THREEXUI_BASE_URL, THREEXUI_USERNAME, THREEXUI_PASSWORD
+from db import get_setting
+import adb
 
 TZ = timezone.utc
 logger = logging.getLogger("pingx.xui")
 
+# settings key holding {operation: variant label} of the endpoint variants known to work on this panel
+CAPS_SETTING_KEY = "XUI_CAPABILITIES"
+
 
 class ThreeXUIError(RuntimeError):
     pass
 
 
+# Outermost public operation of the current task; every HTTP round-trip is booked against it.
+_current_op: contextvars.ContextVar[str | None] = contextvars.ContextVar("xui_op", default=None)
+
+
+def _tracked(op: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            token = None
+            if _current_op.get() is None:
+                token = _current_op.set(op)
+                self.op_calls[op] += 1
+            try:
+                return await fn(self, *args, **kwargs)
+            finally:
+                if token is not None:
+                    _current_op.reset(token)
+
+        return wrapper
+
+    return deco
+
+
+def _norm_id(value) -> str:
+    return str(value or "").replace("-", "")
+
+
+def _with_traffic(client: dict, st: dict | None) -> dict:
+    """Client settings entry with up/down (and total/expiry it lacks) taken from its traffic row."""
+    merged = dict(client)
+    if st:
+        merged["up"] = st.get("up") or 0
+        merged["down"] = st.get("down") or 0
+        for key in ("total", "expiryTime"):
+            if not merged.get(key) and st.get(key):
+                merged[key] = st.get(key)
+    return merged
+
+
+class InboundSnapshot:
+    """
+    One parsed copy of an inbound for a sync cycle.
+    Clients from the settings JSON are merged with their `clientStats` traffic row and
+    indexed by id, email and subId so every lookup in the cycle is a dict hit.
+    """
+
+    def __init__(self, inbound_id: int, inbound: dict):
+        self.inbound_id = int(inbound_id)
+        self.inbound = inbound or {}
+        s = self.inbound.get("settings")
+        try:
+            s = json.loads(s) if isinstance(s, str) else (s or {})
+        except Exception:
+            s = {}
+        stats = self.inbound.get("clientStats")
+        self.has_traffic = isinstance(stats, list)
+        traffic = {st.get("email"): st for st in (stats or []) if isinstance(st, dict) and st.get("email")}
+        self.by_id: dict[str, dict] = {}
+        self.by_email: dict[str, dict] = {}
+        self.by_sub: dict[str, dict] = {}
+        for c in s.get("clients") or []:
+            if not isinstance(c, dict):
+                continue
+            stat = ThreeXUISession._format_stat(_with_traffic(c, traffic.get(c.get("email"))))
+            if c.get("id"):
+                self.by_id[_norm_id(c.get("id"))] = stat
+            if c.get("email"):
+                self.by_email[c["email"]] = stat
+            if c.get("subId"):
+                self.by_sub[_norm_id(c.get("subId"))] = stat
+
+    def find(self, client_id: str | None = None, email: str | None = None, sub_id: str | None = None):
+        hit = None
+        if client_id:
+            hit = self.by_id.get(_norm_id(client_id))
+        if hit is None and email:
+            hit = self.by_email.get(email)
+        if hit is None and sub_id:
+            hit = self.by_sub.get(_norm_id(sub_id))
+        return dict(hit) if hit else None
+
+
 class ThreeXUISession:
     def __init__(self, base_url: str, username: str, password: str):
         base = (base_url or "").strip().rstrip("/")
@@ -28,6 +120,60 @@ class ThreeXUISession:
         self.password = password
         self.client: httpx.AsyncClient | None = None
         self._logged_in = False
+        # Earliest expiry (epoch seconds) of the session cookies; None for browser-session cookies.
+        self._session_expires_at: float | None = None
+        self.op_calls: Counter = Counter()
+        self.roundtrips: Counter = Counter()
+        self._caps: dict[str, str] | None = None
+        # Re-login is single-flight: callers note the generation they used and only the first
+        # one to report it stale logs in again. Replaced clients are closed once idle.
+        self._login_lock = asyncio.Lock()
+        self._generation = 0
+        self._inflight: Counter = Counter()
+        self._retired: set = set()
+
+    # --- endpoint capability cache ---
+
+    def _load_caps(self) -> dict[str, str]:
+        if self._caps is None:
+            try:
+                caps = json.loads(get_setting(CAPS_SETTING_KEY, "{}") or "{}")
+                self._caps = {str(k): str(v) for k, v in caps.items()} if isinstance(caps, dict) else {}
+            except Exception:
+                self._caps = {}
+        return self._caps
+
+    async def _save_caps(self):
+        try:
+            await adb.set_setting(CAPS_SETTING_KEY, json.dumps(self._caps or {}, sort_keys=True))
+        except Exception:
+            logger.warning("3xui capability cache persist failed", exc_info=True)
+
+    def _ordered_attempts(self, op: str, attempts: list) -> tuple[list, str | None]:
+        """Put the variant remembered for `op` first. Each attempt's first element is its label."""
+        known = self._load_caps().get(op)
+        if known:
+            attempts = sorted(attempts, key=lambda a: a[0] != known)
+        return attempts, known
+
+    async def _remember_variant(self, op: str, label: str):
+        caps = self._load_caps()
+        if caps.get(op) != label:
+            logger.info("3xui capability %s -> %s", op, label)
+            caps[op] = label
+            await self._save_caps()
+
+    async def _forget_variant(self, op: str, label: str | None):
+        caps = self._load_caps()
+        if label and caps.get(op) == label:
+            logger.warning("3xui capability %s variant %s stopped working, re-probing", op, label)
+            caps.pop(op, None)
+            await self._save_caps()
+
+    def roundtrip_stats(self) -> dict[str, tuple[int, int]]:
+        """Operation -> (calls, panel round-trips) since start, including logins."""
+        ops = set(self.op_calls) | set(self.roundtrips)
+        return {op: (self.op_calls.get(op, 0), self.roundtrips.get(op, 0)) for op in sorted(ops)}
 
     def _sanitize(self, obj):
         if obj is None:
@@ -47,23 +193,58 @@ class ThreeXUISession:
     def _create_client(self) -> httpx.AsyncClient:
         return httpx.AsyncClient(base_url=self.base, timeout=20.0, follow_redirects=True)
 
-    async def _reset_client(self):
-        if self.client:
-            try:
-                await self.client.aclose()
-            except Exception:
-                pass
-        self.client = self._create_client()
-        self._logged_in = False
+    @staticmethod
+    async def _close_quietly(client: httpx.AsyncClient):
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+
+    async def _retire(self, client: httpx.AsyncClient | None):
+        """Close a replaced client now if idle, otherwise when its last request returns."""
+        if client is None:
+            return
+        if self._inflight[client]:
+            self._retired.add(client)
+        else:
+            self._inflight.pop(client, None)
+            await self._close_quietly(client)
 
     async def close(self):
         if self.client:
             await self.client.aclose()
             self.client = None
             self._logged_in = False
+            self._session_expires_at = None
+
+    async def _send(self, method: str, path: str, client: httpx.AsyncClient | None = None, **kwargs) -> httpx.Response:
+        self.roundtrips[_current_op.get() or "other"] += 1
+        client = client or self.client
+        self._inflight[client] += 1
+        try:
+            return await client.request(method, path, **kwargs)
+        finally:
+            self._inflight[client] -= 1
+            if not self._inflight[client]:
+                del self._inflight[client]
+                if client in self._retired:
+                    self._retired.discard(client)
+                    await self._close_quietly(client)
+
+    @staticmethod
+    def _cookie_expiry(client: httpx.AsyncClient) -> float | None:
+        try:
+            expiries = [c.expires for c in client.cookies.jar if c.expires]
+        except Exception:
+            return None
+        return float(min(expiries)) if expiries else None
+
+    def _session_expiring(self, margin: float = 30.0) -> bool:
+        return self._session_expires_at is not None and time.time() >= self._session_expires_at - margin
 
     async def _login(self):
-        await self._reset_client()
+        """Log in on a fresh client and swap it in; call with _login_lock held (see _relogin)."""
+        client = self._create_client()
         payload = {"username": self.username, "password": self.password}
         attempts = [
             ("POST", "/login", None, payload, None),
@@ -73,29 +254,55 @@ class ThreeXUISession:
         last_err = None
         for method, path, json_body, data_body, headers in attempts:
             try:
-                r = await self.client.request(method, path, json=json_body, data=data_body, headers=headers)
+                r = await self._send(method, path, client=client, json=json_body, data=data_body, headers=headers)
                 if r.status_code in (200, 204, 302, 303):
+                    old, self.client = self.client, client
                     self._logged_in = True
+                    self._session_expires_at = self._cookie_expiry(client)
+                    self._generation += 1
+                    await self._retire(old)
                     return
                 last_err = f"{path} -> {r.status_code} {r.text[:200]}"
             except Exception as e:  # noqa: PERF203 - report last error
                 last_err = e
+        await self._close_quietly(client)
         raise ThreeXUIError(f"Login to 3x-ui failed: {last_err}")
 
-    async def _ensure(self):
-        if not self.client:
-            self.client = self._create_client()
-        if not self._logged_in:
-            await self._login()
-            return
-        try:
-            ping = await self.client.get("/panel/api/inbounds/list")
-            if ping.status_code == 401 or self._looks_like_html(ping):
-                await self._reset_client()
+    async def _relogin(self, seen_generation: int):
+        """
+        Log in again unless the session already changed since `seen_generation`.
+        Concurrent requests that hit the same expired session wait here for one login and then
+        retry on the new client.
+        """
+        async with self._login_lock:
+            if self._generation == seen_generation:
                 await self._login()
-        except Exception:
-            await self._reset_client()
-            await self._login()
+
+    async def _ensure(self):
+        """
+        Make sure a session exists without touching the panel.
+        Liveness is judged from real responses in `request()` (401 / HTML login page /
+        transport errors) and from the cookie expiry recorded at login.
+        """
+        if not self._logged_in or self._session_expiring():
+            await self._relogin(self._generation)
+
+    async def keepalive(self, interval: float = 300.0):
+        """
+        Background task: re-login shortly before the session cookie expires.
+        Costs nothing for panels that issue browser-session cookies; those are re-logged lazily on failure.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if not self._logged_in or not self._session_expiring(margin=interval + 30):
+                continue
+            token = _current_op.set("keepalive")
+            try:
+                await self._relogin(self._generation)
+            except Exception:
+                logger.warning("3xui keepalive re-login failed", exc_info=True)
+            finally:
+                _current_op.reset(token)
 
     @staticmethod
     def _looks_like_html(resp: httpx.Response) -> bool:
@@ -110,20 +317,29 @@ class ThreeXUISession:
 
     async def request(self, method: str, path: str, json_data=None, params=None, data=None, headers=None):
         await self._ensure()
+        generation = self._generation
         safe_json = self._sanitize(json_data)
         safe_data = self._sanitize(data)
         safe_headers = self._sanitize(headers)
         logger.info("3xui request %s %s json=%s params=%s data=%s headers=%s", method, path, safe_json, params, safe_data, safe_headers)
 
         async def _do_request():
-            return await self.client.request(method, path, json=json_data, params=params, data=data, headers=headers)
+            return await self._send(method, path, json=json_data, params=params, data=data, headers=headers)
 
-        r = await _do_request()
+        try:
+            r = await _do_request()
+        except (httpx.ConnectError, httpx.RemoteProtocolError):
+            # Dropped keep-alive connection or panel restart: the panel never handled the request,
+            # so start a fresh client/session and retry once. Timeouts may have been applied (an
+            # addClient would double up), so they are not retried.
+            logger.warning("3xui transport error on %s %s, reconnecting", method, path)
+            await self._relogin(generation)
+            generation = self._generation
+            r = await _do_request()
         if r.status_code == 401 or self._looks_like_html(r):
             # Session likely expired (login page HTML/redirect). Refresh login and retry once.
             logger.warning("3xui session looks expired (status=%s, html=%s), re-authenticating", r.status_code, self._looks_like_html(r))
-            await self._reset_client()
-            await self._login()
+            await self._relogin(generation)
             r = await _do_request()
         logger.info("3xui response %s %s status=%s body=%s", method, path, r.status_code, (r.text[:500] if r.text else ""))
         r.raise_for_status()
@@ -132,8 +348,13 @@ class ThreeXUISession:
         except Exception:
             return {"raw": r.text}
 
+    @_tracked("list_inbounds")
     async def list_inbounds(self):
-        for path in ("/panel/api/inbounds/list", "/panel/inbounds", "/xui/inbound/list"):
+        paths, known = self._ordered_attempts(
+            "list_inbounds",
+            [("panel_api", "/panel/api/inbounds/list"), ("panel", "/panel/inbounds"), ("xui", "/xui/inbound/list")],
+        )
+        for label, path in paths:
             try:
                 d = await self.request("GET", path)
                 obj = d.get("obj") if isinstance(d, dict) else None
@@ -142,11 +363,14 @@ class ThreeXUISession:
                 if obj is None and isinstance(d, dict):
                     obj = d.get("inbounds")
                 if isinstance(obj, list):
+                    await self._remember_variant("list_inbounds", label)
                     return obj
             except Exception:
-                continue
+                pass
+            await self._forget_variant("list_inbounds", known if label == known else None)
         return []
 
+    @_tracked("get_inbound")
     async def get_inbound(self, inbound_id: int):
         for p in (f"/panel/api/inbounds/get/{inbound_id}",):
             try:
@@ -160,6 +384,33 @@ class ThreeXUISession:
                 return it
         return None
 
+    @_tracked("snapshot_inbounds")
+    async def snapshot_inbounds(self, inbound_ids) -> dict[int, InboundSnapshot]:
+        """
+        Fetch and index the given inbounds once.
+        The list endpoint returns every inbound together with `clientStats`, so a single
+        request covers all inbounds; per-inbound `get` is only used for ids it did not return.
+        """
+        wanted = {int(x) for x in inbound_ids or () if str(x).strip().lstrip("-").isdigit()}
+        snaps: dict[int, InboundSnapshot] = {}
+        if not wanted:
+            return snaps
+        try:
+            for it in await self.list_inbounds():
+                try:
+                    iid = int(it.get("id"))
+                except Exception:
+                    continue
+                if iid in wanted:
+                    snaps[iid] = InboundSnapshot(iid, it)
+        except Exception:
+            logger.warning("3xui inbound list for snapshot failed", exc_info=True)
+        for iid in wanted - snaps.keys():
+            ib = await self.get_inbound(iid)
+            if ib:
+                snaps[iid] = InboundSnapshot(iid, ib)
+        return snaps
+
     async def _verify_client_added(self, inbound_id: int, email: str, client_id: str | None = None):
         ib = await self.get_inbound(inbound_id)
         if not ib:
@@ -195,6 +446,7 @@ class ThreeXUISession:
                 res[key] = 0
         return res
 
+    @_tracked("add_client")
     async def add_client(
         self, inbound_id: int, email: str, expire_days: int, data_gb: int, remark: str, limit_ip: int | None = None
     ):
@@ -216,6 +468,7 @@ class ThreeXUISession:
 
         attempts = [
             (
+                "panel_json",
                 "POST",
                 "/panel/api/inbounds/addClient",
                 {"id": int(inbound_id), "client": json.dumps(payload, ensure_ascii=False)},
@@ -223,6 +476,7 @@ class ThreeXUISession:
                 None,
             ),
             (
+                "panel_form",
                 "POST",
                 "/panel/api/inbounds/addClient",
                 None,
@@ -230,6 +484,7 @@ class ThreeXUISession:
                 {"Content-Type": "application/x-www-form-urlencoded"},
             ),
             (
+                "panel_settings",
                 "POST",
                 "/panel/api/inbounds/addClient",
                 {"id": int(inbound_id), "settings": json.dumps({"clients": [payload]}, ensure_ascii=False)},
@@ -237,6 +492,7 @@ class ThreeXUISession:
                 None,
             ),
             (
+                "api_json",
                 "POST",
                 "/api/inbounds/addClient",
                 {"id": int(inbound_id), "client": json.dumps(payload, ensure_ascii=False)},
@@ -244,6 +500,7 @@ class ThreeXUISession:
                 None,
             ),
             (
+                "xui_json",
                 "POST",
                 "/xui/inbound/addClient",
                 {"id": int(inbound_id), "client": json.dumps(payload, ensure_ascii=False)},
@@ -251,21 +508,27 @@ class ThreeXUISession:
                 None,
             ),
         ]
+        attempts, known = self._ordered_attempts("add_client", attempts)
         last_err = None
         last_resp = None
-        for method, path, json_body, data_body, headers in attempts:
+        for label, method, path, json_body, data_body, headers in attempts:
             try:
                 resp = await self.request(method, path, json_data=json_body, data=data_body, headers=headers)
                 last_resp = resp
+                if label == known and isinstance(resp, dict) and resp.get("success") is True:
+                    # Variant already proven on this panel: trust the success flag, skip the verify fetch.
+                    return {"client": payload, "resp": resp}
                 v = await self._verify_client_added(inbound_id, email=email, client_id=new_id)
                 if v:
+                    await self._remember_variant("add_client", label)
                     payload.update({k: v for k, v in v.items()})
                     return {"client": payload, "resp": resp}
                 if isinstance(resp, dict) and resp.get("success") is True:
                     return {"client": payload, "resp": resp, "warn": "not verified, success flag only"}
             except Exception as e:
                 last_err = e
-                continue
+            if label == known:
+                await self._forget_variant("add_client", known)
         try:
             v = await self._verify_client_added(inbound_id, email=email)
             if v:
@@ -379,23 +642,25 @@ class ThreeXUISession:
         payload["id"] = int(payload.get("id", inbound_id))
         return payload
 
+    @_tracked("update_client")
     async def update_client(self, inbound_id: int, client_id: str, client_payload: dict):
         payload_str = json.dumps(client_payload, ensure_ascii=False)
         attempts = [
             # JSON body with client as string
-            ("POST", f"/panel/api/inbounds/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
+            ("panel_json", "POST", f"/panel/api/inbounds/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
             # Form body with client string
-            ("POST", f"/panel/api/inbounds/updateClient/{client_id}", None, {"id": int(inbound_id), "client": payload_str}, {"Content-Type": "application/x-www-form-urlencoded"}),
+            ("panel_form", "POST", f"/panel/api/inbounds/updateClient/{client_id}", None, {"id": int(inbound_id), "client": payload_str}, {"Content-Type": "application/x-www-form-urlencoded"}),
             # JSON body with client as raw dict
-            ("POST", f"/panel/api/inbounds/updateClient/{client_id}", {"id": int(inbound_id), "client": client_payload}, None, None),
+            ("panel_raw", "POST", f"/panel/api/inbounds/updateClient/{client_id}", {"id": int(inbound_id), "client": client_payload}, None, None),
             # Alternate path with json body
-            ("POST", f"/panel/api/inbounds/{int(inbound_id)}/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
+            ("panel_inbound_path", "POST", f"/panel/api/inbounds/{int(inbound_id)}/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
             # API prefixed path
-            ("POST", f"/api/inbounds/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
+            ("api_json", "POST", f"/api/inbounds/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
             # xui prefixed path
-            ("POST", f"/xui/inbound/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
+            ("xui_json", "POST", f"/xui/inbound/updateClient/{client_id}", {"id": int(inbound_id), "client": payload_str}, None, None),
             # settings-based update (single client) via panel api
             (
+                "panel_settings",
                 "POST",
                 f"/panel/api/inbounds/updateClient/{client_id}",
                 {"id": int(inbound_id), "settings": json.dumps({"clients": [client_payload]}, ensure_ascii=False)},
@@ -403,16 +668,19 @@ class ThreeXUISession:
                 None,
             ),
         ]
+        attempts, known = self._ordered_attempts("update_client", attempts)
         last = None
-        for method, path, json_body, data_body, headers in attempts:
+        for label, method, path, json_body, data_body, headers in attempts:
             try:
                 resp = await self.request(method, path, json_data=json_body, data=data_body, headers=headers)
                 last = resp
-                if isinstance(resp, dict) and resp.get("success") is False:
-                    continue
-                return resp
+                if not (isinstance(resp, dict) and resp.get("success") is False):
+                    await self._remember_variant("update_client", label)
+                    return resp
             except Exception as e:
                 last = e
+            if label == known:
+                await self._forget_variant("update_client", known)
         # Fallback: read full inbound settings, replace target client, push back
         try:
             inbound = await self.get_inbound(inbound_id)
@@ -447,6 +715,7 @@ class ThreeXUISession:
             last = e
         raise ThreeXUIError(f"updateClient failed: {last}")
 
+    @_tracked("rotate_subid")
     async def rotate_subid(self, inbound_id: int, client_id: str, email: str | None = None) -> str:
         inbound = await self.get_inbound(inbound_id)
         if not inbound:
@@ -465,38 +734,60 @@ class ThreeXUISession:
         await self.update_client(inbound_id, real_id, payload)
         return new_sub
 
+    @_tracked("get_client_stats")
     async def get_client_stats(self, inbound_id: int, client_id: str, email: str | None = None):
+        """
+        The client's entry from the inbound settings (id, subId, flow, ... as update_client expects)
+        with up/down overlaid from its traffic row. Stock `inbounds/get` carries no `clientStats`;
+        the traffic endpoint fills in then, but its row never replaces the client itself.
+        """
+        client = None
         try:
             inbound = await self.get_inbound(inbound_id)
             if inbound:
-                s = inbound.get("settings")
-                s = json.loads(s) if isinstance(s, str) else (s or {})
-                for c in s.get("clients") or []:
-                    if str(c.get("id")) == str(client_id) or (email and c.get("email") == email):
-                        return self._format_stat(c)
+                snap = InboundSnapshot(inbound_id, inbound)
+                client = snap.find(client_id=client_id, email=email)
+                if client and snap.has_traffic:
+                    return client
         except Exception:
             pass
-        paths = (
-            f"/panel/api/inbounds/getClientTraffics/{email or client_id}",
-            f"/panel/api/inbounds/getClientTrafficsById/{client_id}",
-            f"/api/inbounds/getClientTraffics/{email or client_id}",
-            f"/api/inbounds/getClientTrafficsById/{client_id}",
-            f"/xui/inbound/getClientTraffics/{email or client_id}",
-            f"/xui/inbound/getClientTrafficsById/{client_id}",
-        )
-        for p in paths:
+        traffic = await self._client_traffic(inbound_id, client_id, email)
+        if client is None:
+            if traffic:
+                traffic.pop("id", None)  # numeric traffic-row id, not the client UUID
+            return traffic
+        return self._format_stat(_with_traffic(client, traffic))
+
+    async def _client_traffic(self, inbound_id: int, client_id: str, email: str | None = None):
+        paths = [
+            ("panel_email", f"/panel/api/inbounds/getClientTraffics/{email or client_id}"),
+            ("panel_id", f"/panel/api/inbounds/getClientTrafficsById/{client_id}"),
+            ("api_email", f"/api/inbounds/getClientTraffics/{email or client_id}"),
+            ("api_id", f"/api/inbounds/getClientTrafficsById/{client_id}"),
+            ("xui_email", f"/xui/inbound/getClientTraffics/{email or client_id}"),
+            ("xui_id", f"/xui/inbound/getClientTrafficsById/{client_id}"),
+        ]
+        paths, known = self._ordered_attempts("client_traffic", paths)
+        for label, p in paths:
             try:
                 d = await self.request("GET", p, params={"inboundId": inbound_id})
                 if isinstance(d, dict) and "obj" in d:
                     obj = d["obj"]
                     if isinstance(obj, dict):
+                        await self._remember_variant("client_traffic", label)
                         return self._format_stat(obj)
                     if isinstance(obj, list):
                         for it in obj:
                             if str(it.get("id")) == str(client_id) or (email and it.get("email") == email):
+                                await self._remember_variant("client_traffic", label)
                                 return self._format_stat(it)
+                    if label == known:
+                        # The endpoint answered; the client just isn't there.
+                        return None
             except Exception:
-                continue
+                pass
+            if label == known:
+                await self._forget_variant("client_traffic", known)
         return None
 
 